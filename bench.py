@@ -0,0 +1,179 @@
+import sys
+import argparse
+import json
+import statistics
+import subprocess
+import time
+import typing as T
+from pathlib import Path
+
+HERE = Path(__file__).parent
+
+STARTUP_EXPR = '`//div[@class="product"]` / {name: `.//h2`.text, price: `.//p`.text, url: `.//a`@href}'
+
+STARTUP_CASES = {
+    'import': 'import heq',
+    'import+grammar': 'import heq; heq._load_parsimonious()',
+    'parse(parsimonious)': 'import heq; heq.parse({!r}, "parsimonious")'.format(STARTUP_EXPR),
+    'parse(rd)': 'import heq; heq.parse({!r}, "rd")'.format(STARTUP_EXPR),
+}
+
+def time_subprocess(code: str, repeat: int) -> T.List[float]:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True, cwd=str(HERE))
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def bench_startup(args):
+    baseline = min(time_subprocess('pass', args.repeat))
+    print('{:<24} {:>10} {:>10} {:>12}'.format('case', 'min [ms]', 'mean [ms]', 'over python'))
+    for name, code in STARTUP_CASES.items():
+        timings = time_subprocess(code, args.repeat)
+        print('{:<24} {:>10.1f} {:>10.1f} {:>12.1f}'.format(
+            name, 1000 * min(timings), 1000 * statistics.mean(timings), 1000 * (min(timings) - baseline)))
+
+def generate_products(rows: int) -> str:
+    items = ''.join(
+        '<div class="product"><h2 class="name">Product {0}</h2><p class="price">${0}</p>'
+        '<ul class="features"><li>Feature {0}a</li><li>Feature {0}b</li></ul>'
+        '<a href="/products/{0}">Details</a></div>\n'.format(i)
+        for i in range(rows))
+    return '<html><body><div id="header">Welcome</div>\n' + items + '</body></html>'
+
+def generate_hn(rows: int) -> str:
+    items = ''.join(
+        '<tr class="athing" id="{0}"><td class="title"><span class="rank">{0}.</span></td>'
+        '<td class="title"><span class="titleline"><a href="https://example.com/{0}">Story {0}</a>'
+        '<span class="sitebit"><a href="from?site={0}">example.com</a></span></span></td></tr>'
+        '<tr><td class="subtext"><span class="score">{0} points</span></td></tr>\n'.format(i)
+        for i in range(rows))
+    return '<html><body><table class="itemlist">' + items + '</table></body></html>'
+
+def generate_deep(rows: int, depth: int = 30) -> str:
+    item = '<div class="level">' * depth + '<span class="leaf">leaf {}</span>' + '</div>' * depth
+    return '<html><body>' + ''.join(item.format(i) + '\n' for i in range(rows)) + '</body></html>'
+
+def generate_wide(rows: int, columns: int = 50) -> str:
+    head = '<tr>' + ''.join('<th>c{}</th>'.format(j) for j in range(columns)) + '</tr>'
+    body = ''.join(
+        '<tr class="row">' + ''.join('<td class="c{1}">{0}.{1}</td>'.format(i, j) for j in range(columns)) + '</tr>\n'
+        for i in range(rows))
+    return '<html><body><table>' + head + body + '</table></body></html>'
+
+def generate_tables(rows: int, size: int = 10) -> str:
+    tables = ''.join(
+        '<table>' + ''.join('<tr><td>{}.{}</td><td class="v">{}</td></tr>'.format(i, j, j) for j in range(size)) + '</table>\n'
+        for i in range(rows // size))
+    return '<html><body>' + tables + '</body></html>'
+
+GENERATORS = {
+    'products': generate_products,
+    'hn': generate_hn,
+    'deep': generate_deep,
+    'wide': generate_wide,
+    'tables': generate_tables,
+}
+
+CASES = [
+    ('products-xpath', 'products', '''`//div[@class="product"]` / {
+        name: `.//h2[@class="name"]`.text,
+        price: `.//p[@class="price"]`.text,
+        features: `.//li` / text,
+        url: `.//a`@href
+    }'''),
+    ('products-css', 'products', '''$`div.product` / {
+        name: $`h2.name`.text,
+        price: $`p.price`.text,
+        features: $`li` / text,
+        url: $`a`@href
+    }'''),
+    ('products-header', 'products', '{ header: `//div[@id="header"]`.text }'),
+    ('hn-xpath', 'hn', '''`//tr[@class="athing"]` / {
+        title: `(./td[@class="title"]//a)[1]`.text,
+        link: `(./td[@class="title"]//a)[1]`@href,
+    }'''),
+    ('hn-css', 'hn', '''$`tr.athing` / {
+        title: $`span.titleline > a`[0].text,
+        link: $`span.titleline > a`@href,
+    }'''),
+    ('deep-xpath', 'deep', '`//span[@class="leaf"]` / text'),
+    ('deep-css', 'deep', '$`div.level > span.leaf` / text'),
+    ('wide-xpath', 'wide', '`//tr[@class="row"]` / {first: `./td[1]`.text, last: `./td[last()]`.text, cells: `./td` / text}'),
+    ('wide-css', 'wide', '$`tr.row` / {first: $`td.c0`.text, cells: $`td` / text}'),
+    ('tables-nested', 'tables', '`//table` / {rows: `.//tr` / {a: `.//td`[0].text, b: `.//td[@class="v"]`.text}}'),
+]
+
+PHASES = ['parse', 'html', 'evaluate', 'serialize']
+
+def time_call(func, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def run_case(source: str, html: bytes, repeat: int, index: bool = False, batch: bool = False) -> T.Dict[str, float]:
+    import heq
+    parse = heq._parse.__wrapped__
+    expr = parse(source)
+    tree = heq.extract_tree(html)
+    compiled = heq.CompiledExpr(expr, index=index, batch=batch)
+    result = compiled(tree)
+    encode = heq.json_encoder()
+    return {
+        'parse': time_call(lambda: parse(source), repeat),
+        'html': time_call(lambda: heq.extract_tree(html), repeat),
+        'evaluate': time_call(lambda: compiled(tree), repeat),
+        'serialize': time_call(lambda: encode(result), repeat),
+    }
+
+def bench_suite(args):
+    results = {}
+    documents = {}
+    print('{:<18} {:>8}'.format('case', 'rows') + ''.join(' {:>14}'.format(p + ' [ms]') for p in PHASES))
+    for name, kind, source in CASES:
+        if args.filter and not any(f in name for f in args.filter):
+            continue
+        for rows in args.rows:
+            if (kind, rows) not in documents:
+                documents[(kind, rows)] = GENERATORS[kind](rows).encode('utf-8')
+            key = '{}/{}'.format(name, rows)
+            results[key] = run_case(source, documents[(kind, rows)], args.repeat, args.index, args.batch_maps)
+            print('{:<18} {:>8}'.format(name, rows) + ''.join(' {:>14.2f}'.format(1000 * results[key][p]) for p in PHASES))
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        print()
+        print('ratio to {} (< 1 is faster)'.format(args.compare))
+        for key, timings in results.items():
+            if key not in baseline:
+                continue
+            ratios = ''.join(' {:>14.2f}'.format(timings[p] / baseline[key][p]) if baseline[key].get(p) else ' {:>14}'.format('-') for p in PHASES)
+            print('{:<27}'.format(key) + ratios)
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+def main():
+    parser = argparse.ArgumentParser(description='heq benchmarks')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('startup', help='interpreter startup, import and first parse() time')
+    p.add_argument('--repeat', '-r', type=int, default=20)
+    p.set_defaults(func=bench_startup)
+    p = sub.add_parser('suite', help='time parse(), HTML parsing, evaluation and serialization on synthetic documents')
+    p.add_argument('--rows', type=int, nargs='+', default=[1000, 10000])
+    p.add_argument('--repeat', '-r', type=int, default=5)
+    p.add_argument('--filter', '-k', nargs='+', help='only run cases whose name contains one of these strings')
+    p.add_argument('--index', action='store_true', help='evaluate with a DocumentIndex')
+    p.add_argument('--batch-maps', action='store_true', help='evaluate with batch=True, e.g. to --compare against a run without it')
+    p.add_argument('--save', help='save timings as JSON, e.g. as a baseline')
+    p.add_argument('--compare', help='compare against timings saved with --save')
+    p.set_defaults(func=bench_suite)
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,44 @@
+import os
 import sys
 import argparse
 import json
+import re
+import bisect
+import functools
+import contextvars
+import itertools
+import threading
+from pathlib import Path
 from dataclasses import dataclass
 import typing as T
 
-Grammar = None
+__version__ = '0.0.3'
 
-try:
-    from parsimonious.grammar import Grammar
-except ImportError:
-    pass
+XPATH_CACHE_SIZE = 1024
+PARSE_CACHE_SIZE = 256
+
+@functools.lru_cache(maxsize=XPATH_CACHE_SIZE)
+def compile_xpath(s: str):
+    import lxml.etree
+    return lxml.etree.XPath(s)
+
+@functools.lru_cache(maxsize=XPATH_CACHE_SIZE)
+def css_to_xpath(s: str) -> str:
+    from cssselect import HTMLTranslator
+    return HTMLTranslator().css_to_xpath(s)
+
+def _nth_xpath(path: str, index: int) -> str:
+    if index >= 0:
+        return '({})[{}]'.format(path, index + 1)
+    elif index == -1:
+        return '({})[last()]'.format(path)
+    return '({})[last() - {}]'.format(path, -index - 1)
+
+def _select_nth(compiled, tree):
+    selected = compiled(tree)
+    if len(selected) == 0:
+        raise IndexError('list index out of range')
+    return selected[0]
 
 @dataclass(frozen=True)
 class xpath:
@@ -19,6 +48,14 @@ class xpath:
     def text(self):
         return dot_text(self)
 
+    @property
+    def strip(self):
+        return dot_text(self, 'strip')
+
+    @property
+    def normalize(self):
+        return dot_text(self, 'normalize')
+
     def __truediv__(self, other):
         return map_pred(self, other)
 
@@ -28,8 +65,11 @@ class xpath:
     def __getitem__(self, index):
         return selector_indexed(self, index)
 
+    def to_xpath(self) -> str:
+        return self.xpath
+
     def select(self, tree):
-        return tree.xpath(self.xpath)
+        return compile_xpath(self.xpath)(tree)
 
 @dataclass(frozen=True)
 class css:
@@ -39,6 +79,14 @@ class css:
     def text(self):
         return dot_text(self)
 
+    @property
+    def strip(self):
+        return dot_text(self, 'strip')
+
+    @property
+    def normalize(self):
+        return dot_text(self, 'normalize')
+
     def __truediv__(self, other):
         return map_pred(self, other)
 
@@ -48,8 +96,15 @@ class css:
     def __getitem__(self, index):
         return selector_indexed(self, index)
 
-    def select(self, tree):
-        return tree.cssselect(self.css)
+    def to_xpath(self) -> str:
+        return css_to_xpath(self.css)
+
+    def select(self, tree, index: T.Optional['DocumentIndex'] = None):
+        if index is not None:
+            selected = index.select(self.css, tree)
+            if selected is not None:
+                return selected
+        return compile_xpath(css_to_xpath(self.css))(tree)
 
 @dataclass(frozen=True)
 class selector_indexed:
@@ -60,15 +115,27 @@ class selector_indexed:
     def text(self):
         return dot_text(self)
 
+    @property
+    def strip(self):
+        return dot_text(self, 'strip')
+
+    @property
+    def normalize(self):
+        return dot_text(self, 'normalize')
+
     def __matmul__(self, attr):
         return at_attr(self, attr)
 
+    def to_xpath(self) -> str:
+        return _nth_xpath(self.sel.to_xpath(), self.index)
+
     def select(self, tree):
-        return self.sel.select(tree)[self.index]
+        return _select_nth(compile_xpath(self.to_xpath()), tree)
 
 @dataclass(frozen=True)
 class dot_text:
     expr: 'Expr'
+    func: str = 'text'
 
 @dataclass(frozen=True)
 class at_attr:
@@ -84,17 +151,136 @@ class map_pred:
 class unary_func:
     name: str
 text = unary_func('text')
+strip = unary_func('strip')
+normalize = unary_func('normalize')
 
 @dataclass(frozen=True)
 class attr:
     name: str
 
-Expr = T.Union[xpath, css, dot_text, at_attr, map_pred, unary_func, attr, T.Dict[str, 'Expr']]
+@dataclass(frozen=True)
+class hoisted:
+    """Marks a value inside a `/` mapping that does not depend on the
+    element mapped over, so that it is evaluated once per evaluation of the
+    whole expression; see `hoist`."""
+    expr: 'Expr'
 
-if Grammar is not None:
-    from parsimonious.nodes import NodeVisitor
+Expr = T.Union[xpath, css, dot_text, at_attr, map_pred, unary_func, attr, hoisted, T.Dict[str, 'Expr']]
+
+def iter_nodes(expr: Expr) -> T.Iterator[Expr]:
+    yield expr
+    if isinstance(expr, map_pred):
+        yield from iter_nodes(expr.expr)
+        yield from iter_nodes(expr.pred)
+    elif isinstance(expr, (dot_text, at_attr, hoisted)):
+        yield from iter_nodes(expr.expr)
+    elif isinstance(expr, selector_indexed):
+        yield from iter_nodes(expr.sel)
+    elif isinstance(expr, dict):
+        for v in expr.values():
+            yield from iter_nodes(v)
+
+def iter_selectors(expr: Expr) -> T.Iterator[T.Union[xpath, css]]:
+    return (e for e in iter_nodes(expr) if isinstance(e, (xpath, css)))
+
+INDEX_MAX_ANCHORS = 16
+
+@functools.lru_cache(maxsize=XPATH_CACHE_SIZE)
+def _index_plan(s: str) -> T.Optional[T.Tuple[str, T.Optional[str]]]:
+    """Returns an XPath selecting the elements of a document that match the
+    first compound selector of the CSS selector `s` and, if there is more to
+    `s`, an XPath selecting its matches from such an element. Returns None
+    unless the first compound tests nothing but tag name, ids and classes."""
+    import cssselect
+    from cssselect import HTMLTranslator
+    try:
+        selectors = cssselect.parse(s)
+    except cssselect.SelectorError:
+        return None
+    if len(selectors) != 1 or selectors[0].pseudo_element is not None:
+        return None
+    first = selectors[0].parsed_tree
+    combined = False
+    while isinstance(first, cssselect.parser.CombinedSelector):
+        first = first.selector
+        combined = True
+    node = first
+    while isinstance(node, (cssselect.parser.Class, cssselect.parser.Hash)):
+        node = node.selector
+    if not isinstance(node, cssselect.parser.Element) or node.namespace is not None:
+        return None
+    if node is first and node.element in (None, '*'):
+        return None
+    translator = HTMLTranslator()
+    anchor = 'descendant-or-self::' + str(translator.xpath(first))
+    rest = translator.css_to_xpath(s, prefix='self::') if combined else None
+    return anchor, rest
+
+class DocumentIndex:
+    """The elements of a document in document order, for answering CSS
+    selectors that start with a tag name, id or class without searching the
+    tree each time. The elements are numbered on the first call to `select`,
+    and the elements matching such a start are looked up with one XPath
+    call over the whole document the first time it is used."""
 
-    grammar = Grammar(r'''
+    def __init__(self, tree):
+        self.root = tree.getroottree().getroot()
+        self._elements = None
+        self._selectors = {}
+
+    def _end(self, n: int) -> int:
+        """Returns the number of the first element after the subtree of the `n`th one."""
+        end = self._ends.get(n)
+        if end is None:
+            end = len(self._elements)
+            el = self._elements[n]
+            while el is not self.root:
+                following = el.getnext()
+                if following is not None:
+                    end = self._pre[following]
+                    break
+                el = el.getparent()
+            self._ends[n] = end
+        return end
+
+    def select(self, sel: str, context) -> T.Optional[list]:
+        """Returns what the CSS selector `sel` selects from `context` (the
+        element itself and its descendants), in document order, or None if
+        the start of `sel` cannot be looked up in the index or matches more
+        than INDEX_MAX_ANCHORS elements that the rest of `sel` would have to
+        be evaluated from."""
+        entry = self._selectors.get(sel)
+        if entry is None:
+            plan = _index_plan(sel)
+            if plan is None:
+                return None
+            if self._elements is None:
+                self._elements = list(self.root.iter())
+                self._pre = {el: n for n, el in enumerate(self._elements)}
+                self._ends = {}
+            anchor, rest = plan
+            pre = self._pre
+            entry = self._selectors[sel] = [pre[x] for x in compile_xpath(anchor)(self.root)], rest and compile_xpath(rest)
+        numbers, rest = entry
+        lo = self._pre.get(context)
+        if lo is None:
+            return None
+        i = bisect.bisect_left(numbers, lo)
+        j = bisect.bisect_left(numbers, self._end(lo), i)
+        elements = self._elements
+        if rest is None:
+            return [elements[n] for n in numbers[i:j]]
+        if j - i > INDEX_MAX_ANCHORS:
+            return None
+        if j - i == 1:
+            return rest(elements[numbers[i]])
+        found = {}
+        for n in numbers[i:j]:
+            for x in rest(elements[n]):
+                found[self._pre[x]] = x
+        return [found[n] for n in sorted(found)]
+
+GRAMMAR = r'''
         s = expr _
         expr = (selector_lit _ "/")? (dict_lit / dottext / atattr / unary_func / attr_lit / selector_lit)
         unary_func = _ ident
@@ -108,13 +294,21 @@ if Grammar is not None:
         backtick_lit = "`" (~r"[^\\`]+" / "\\`" / "\\\\")+ "`"
         single_quote_lit = "'" (~r"[^\\']+" / "\\'" / "\\\\")+ "'"
         double_quote_lit = '"' (~r'[^\\"]+' / '\\"' / "\\\\")+ '"'
-        dottext = selector_lit _ ".text"
+        dottext = selector_lit _ "." text_func
+        text_func = "text" / "strip" / "normalize"
         atattr = selector_lit attr_lit
         attr_lit = _ "@" ~r"[-_0-9a-zA-Z]+"
         ident = ~r"[_a-zA-Z][_0-9a-zA-Z]+"
         _ = ws*
         ws = ~r"\s+"
-    ''')
+    '''
+
+@functools.lru_cache(maxsize=None)
+def _load_parsimonious():
+    from parsimonious.grammar import Grammar
+    from parsimonious.nodes import NodeVisitor
+
+    grammar = Grammar(GRAMMAR)
 
     class ExNodeVisitor(NodeVisitor):
 
@@ -149,7 +343,11 @@ if Grammar is not None:
             return visited_children[-1].text
 
         def visit_dottext(self, node, visited_children):
-            return visited_children[0].text
+            sel, _, _, func = visited_children
+            return dot_text(sel, func)
+
+        def visit_text_func(self, node, visited_children):
+            return node.text
 
         def visit_atattr(self, node, visited_children):
             xp, at = visited_children
@@ -185,136 +383,2134 @@ if Grammar is not None:
         def generic_visit(self, node, visited_children):
             return visited_children or node
 
-    def parse(s: str) -> Expr:
-        return ExNodeVisitor().visit(grammar.parse(s))
+    return grammar, ExNodeVisitor
+
+def __getattr__(name):
+    if name == 'grammar':
+        return _load_parsimonious()[0]
+    elif name == 'ExNodeVisitor':
+        return _load_parsimonious()[1]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+class ParseError(Exception):
+    def __init__(self, text: str, pos: int):
+        self.text = text
+        self.pos = pos
+        line = text.count('\n', 0, pos) + 1
+        column = pos - (text.rfind('\n', 0, pos) + 1) + 1
+        super().__init__(f'Syntax error at line {line}, column {column}: {text[pos:pos+20]!r}')
+
+class _RDParser:
+    _ws = re.compile(r'\s*')
+    _field = re.compile(r'[_a-zA-Z][_0-9a-zA-Z]*')
+    _ident = re.compile(r'[_a-zA-Z][_0-9a-zA-Z]+')
+    _attr_name = re.compile(r'[-_0-9a-zA-Z]+')
+    _int = re.compile(r'\d+')
+    _backtick = re.compile(r'`((?:[^\\`]|\\[\\`])+)`')
+
+    def __init__(self, text: str):
+        self.text = text
+        self.pos = 0
+        self.furthest = 0
+
+    def parse(self) -> Expr:
+        e = self.expr()
+        if e is not None:
+            self.skip_ws()
+            if self.pos == len(self.text):
+                return e
+        raise ParseError(self.text, max(self.pos, self.furthest))
+
+    def skip_ws(self):
+        self.pos = self._ws.match(self.text, self.pos).end()
+
+    def match(self, pattern):
+        m = pattern.match(self.text, self.pos)
+        if m is None:
+            self.furthest = max(self.furthest, self.pos)
+            return None
+        self.pos = m.end()
+        return m
+
+    def literal(self, s: str) -> bool:
+        if self.text.startswith(s, self.pos):
+            self.pos += len(s)
+            return True
+        self.furthest = max(self.furthest, self.pos)
+        return False
+
+    def expr(self):
+        start = self.pos
+        prefix = self.selector_lit()
+        if prefix is not None:
+            self.skip_ws()
+            if not self.literal('/'):
+                prefix = None
+                self.pos = start
+        for alt in (self.dict_lit, self.dottext, self.atattr, self.unary_func, self.attr_lit, self.selector_lit):
+            leaf = alt()
+            if leaf is not None:
+                if prefix is not None:
+                    return prefix / leaf
+                return leaf
+        self.pos = start
+        return None
+
+    def unary_func(self):
+        start = self.pos
+        self.skip_ws()
+        m = self.match(self._ident)
+        if m is None:
+            self.pos = start
+            return None
+        return unary_func(m.group())
+
+    def dict_lit(self):
+        start = self.pos
+        self.skip_ws()
+        if not self.literal('{'):
+            self.pos = start
+            return None
+        d = {}
+        group_start = self.pos
+        fields = []
+        while True:
+            item_start = self.pos
+            field = self.dict_field_value()
+            if field is not None:
+                self.skip_ws()
+                if self.literal(','):
+                    self.skip_ws()
+                    if not self.text.startswith('}', self.pos):
+                        fields.append(field)
+                        continue
+            self.pos = item_start
+            break
+        last = self.dict_field_value()
+        if last is None:
+            self.pos = group_start
+        else:
+            fields.append(last)
+            self.skip_ws()
+            if self.literal(','):
+                self.skip_ws()
+            for k, v in fields:
+                d[k] = v
+        if not self.literal('}'):
+            self.pos = start
+            return None
+        return d
+
+    def dict_field_value(self):
+        start = self.pos
+        self.skip_ws()
+        m = self.match(self._field)
+        if m is not None:
+            self.skip_ws()
+            if self.literal(':'):
+                e = self.expr()
+                if e is not None:
+                    return m.group(), e
+        self.pos = start
+        return None
+
+    def selector_lit(self):
+        start = self.pos
+        self.skip_ws()
+        is_css = self.literal('$')
+        m = self.match(self._backtick)
+        if m is None:
+            self.pos = start
+            return None
+        # mirrors ExNodeVisitor.visit_backtick_lit, which only unescapes a body consisting of a single escape
+        s = {'\\`': '`', '\\\\': '\\'}.get(m.group(1), m.group(1))
+        sel = css(s) if is_css else xpath(s)
+        index_start = self.pos
+        if self.literal('['):
+            n = self.match(self._int)
+            if n is not None and self.literal(']'):
+                return sel[int(n.group())]
+            self.pos = index_start
+        return sel
+
+    def dottext(self):
+        start = self.pos
+        sel = self.selector_lit()
+        if sel is not None:
+            self.skip_ws()
+            if self.literal('.'):
+                for func in TEXT_FUNCS:
+                    if self.literal(func):
+                        return dot_text(sel, func)
+        self.pos = start
+        return None
+
+    def atattr(self):
+        start = self.pos
+        sel = self.selector_lit()
+        if sel is not None:
+            a = self.attr_lit()
+            if a is not None:
+                return sel @ a.name
+        self.pos = start
+        return None
+
+    def attr_lit(self):
+        start = self.pos
+        self.skip_ws()
+        if self.literal('@'):
+            m = self.match(self._attr_name)
+            if m is not None:
+                return attr(m.group())
+        self.pos = start
+        return None
+
+@functools.lru_cache(maxsize=None)
+def _default_parser() -> str:
+    import importlib.util
+    if importlib.util.find_spec('parsimonious') is not None:
+        return 'parsimonious'
+    return 'rd'
+
+def _copy_dicts(e: Expr) -> Expr:
+    """Returns `e` with its dicts, the only mutable nodes, copied."""
+    if isinstance(e, dict):
+        return {k: _copy_dicts(v) for k, v in e.items()}
+    elif isinstance(e, map_pred):
+        return map_pred(_copy_dicts(e.expr), _copy_dicts(e.pred))
+    return e
+
+def parse(s: str, parser: T.Optional[str] = None) -> Expr:
+    """Parses the script `s`. Results are memoized by source text; each call
+    returns its own copy of any dicts, so changing one does not affect later
+    calls."""
+    return _copy_dicts(_parse(s, parser))
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse(s: str, parser: T.Optional[str] = None) -> Expr:
+    if parser is None:
+        parser = _default_parser()
+    if parser == 'parsimonious':
+        grammar, visitor = _load_parsimonious()
+        return visitor().visit(grammar.parse(s))
+    elif parser == 'rd':
+        return _RDParser(s).parse()
+    raise ValueError(f'unknown parser: {parser}')
+
+def cache_dir() -> Path:
+    if os.environ.get('HEQ_CACHE_DIR'):
+        return Path(os.environ['HEQ_CACHE_DIR'])
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return Path(base) / 'heq'
+
+def _atomic_write(path: Path, data: bytes):
+    import tempfile
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+_NODE_TYPES = {cls.__name__: cls for cls in (xpath, css, selector_indexed, dot_text, at_attr, map_pred, unary_func, attr, hoisted)}
+
+def _expr_to_json(e: Expr):
+    """Returns `e` as JSON data: a node as a list of its type name and
+    fields, and a dict as an object."""
+    if isinstance(e, dict):
+        return {k: _expr_to_json(v) for k, v in e.items()}
+    elif isinstance(e, tuple(_NODE_TYPES.values())):
+        import dataclasses
+        return [type(e).__name__, *(_expr_to_json(getattr(e, f.name)) for f in dataclasses.fields(e))]
+    return e
+
+def _expr_from_json(data) -> Expr:
+    """Inverse of `_expr_to_json`; raises ValueError for other data."""
+    if isinstance(data, dict):
+        return {k: _expr_from_json(v) for k, v in data.items()}
+    elif isinstance(data, list):
+        if not data or data[0] not in _NODE_TYPES:
+            raise ValueError(f'not an expression node: {data!r}')
+        try:
+            return _NODE_TYPES[data[0]](*map(_expr_from_json, data[1:]))
+        except TypeError as e:
+            raise ValueError(f'not an expression node: {data!r}') from e
+    elif isinstance(data, (str, int)):
+        return data
+    raise ValueError(f'not an expression: {data!r}')
+
+@functools.lru_cache(maxsize=None)
+def _node_schema() -> str:
+    import dataclasses
+    return ';'.join('{}({})'.format(name, ','.join(f.name for f in dataclasses.fields(cls))) for name, cls in _NODE_TYPES.items())
+
+def load_script(path: str, use_cache: bool = True, parser: T.Optional[str] = None) -> Expr:
+    import hashlib
+    with open(path, 'rb') as fp:
+        source = fp.read()
+    if not use_cache:
+        return parse(source.decode('utf-8'), parser)
+    key = hashlib.sha256(f'{__version__}\0{_node_schema()}\0'.encode('utf-8') + source).hexdigest()
+    cache_path = cache_dir() / 'scripts' / (key + '.json')
+    try:
+        with open(cache_path, 'rb') as fp:
+            return _expr_from_json(json.load(fp))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f'heq: ignoring unreadable script cache {cache_path}: {e}', file=sys.stderr)
+    expr = parse(source.decode('utf-8'), parser)
+    try:
+        _atomic_write(cache_path, json.dumps(_expr_to_json(expr), ensure_ascii=False).encode('utf-8'))
+    except OSError:
+        pass
+    return expr
 
 MAX_LINE_WIDTH = 80
-def pretty_format_internal(obj, depth=0) -> T.List[str]:
+OUTPUT_BUFFER_SIZE = 1 << 16
+def write_pretty(obj, write: T.Callable[[str], T.Any]):
+    """Writes `obj` as `pretty_format` formats it, passing the output to
+    `write` piece by piece. A list or dict is written on one line if its
+    single-line form fits in MAX_LINE_WIDTH columns at its indentation,
+    which is decided by looking ahead at no more than that many columns."""
     import lxml.etree
+    element = lxml.etree._Element
+    dumps = json.JSONEncoder(ensure_ascii=False).encode
+
+    def element_lines(e) -> T.List[str]:
+        return lxml.etree.tostring(e, method='html', pretty_print=True, encoding='unicode').splitlines()
 
-    if isinstance(obj, (int, float, str)) or obj is None:
-        return [json.dumps(obj, ensure_ascii=False)]
-    elif isinstance(obj, list):
-        if len(obj) == 0:
-            return ['[]']
-        elems = [pretty_format_internal(x, depth+1) for x in obj]
-        available = MAX_LINE_WIDTH - 2*depth
-        if all(len(e) == 1 for e in elems) and (sum(len(e[0]) for e in elems) + 2 * (len(obj) - 1) <= available):
-            return ['[{}]'.format(', '.join(e[0] for e in elems))]
-        result = []
-        for i, es in enumerate(elems):
-            for e in es[:-1]:
-                result.append('  ' + e)
-            if i != len(elems) - 1:
-                result.append('  '+es[-1]+',')
+    # single-line forms (or None) of lists, dicts and elements by (id, depth),
+    # kept from a failed attempt on their parent until they are written
+    memo = {}
+
+    def flat(obj, depth: int) -> T.Optional[str]:
+        """Returns the single-line form of `obj` if it is written on one line at `depth`."""
+        if isinstance(obj, (int, float, str)) or obj is None:
+            return dumps(obj)
+        key = (id(obj), depth)
+        if key in memo:
+            return memo[key]
+        if isinstance(obj, element):
+            lines = element_lines(obj)
+            s = lines[0] if len(lines) == 1 else None
+        elif not obj and isinstance(obj, (list, dict)):
+            s = '[]' if isinstance(obj, list) else '{}'
+        elif isinstance(obj, (list, dict)):
+            budget = MAX_LINE_WIDTH - 2*depth
+            is_dict = isinstance(obj, dict)
+            children = obj.values() if is_dict else obj
+            parts = []
+            used = -2
+            for k, v in zip(obj, children):
+                value = flat(v, depth + 1)
+                if value is None:
+                    break
+                if is_dict:
+                    value = dumps(str(k)) + ': ' + value
+                used += 2 + len(value)
+                if used > budget:
+                    break
+                parts.append(value)
             else:
-                result.append('  '+es[-1])
-        ('  ' + e for es in elems for e in es)
-        return ['[', *result, ']']
-    elif isinstance(obj, dict):
-        if len(obj) == 0:
-            return ['{}']
-        elems = {k: pretty_format_internal(v, depth+1) for k, v in obj.items()}
-        available = MAX_LINE_WIDTH - 2*depth
-        if all(len(e) == 1 for e in elems.values()) and (sum(4 + len(k) + len(es[0]) for k, es in elems.items()) + 2 * (len(obj) - 1) <= available):
-            # TODO: escape key
-            return ['{' + ', '.join('"{}": {}'.format(k, es[0]) for k, es in elems.items()) + '}']
-        result = []
-        for i, (k, es) in enumerate(elems.items()):
-            # TODO: escape key
-            result.append('  "{}": {}'.format(k, es[0]))
-            for e in es[1:-1]:
-                result.append('  ' + e)
-            if len(es) > 1:
-                if i != len(elems) - 1:
-                    result.append('  ' + es[-1] + ',')
-                else:
-                    result.append('  ' + es[-1])
-        return ['{', *result,'}']
-    elif isinstance(obj, lxml.etree._Element):
-        return lxml.etree.tostring(obj, method='html', pretty_print=True, encoding='unicode').splitlines()
-    raise TypeError()
-
-def pretty_format(obj):
-    return '\n'.join(pretty_format_internal(obj))
-
-def evaluate(expr: Expr):
-    def _evaluate1(tree):
-        return _evaluate(expr, tree)
-    def _evaluate(e, t):
-        if isinstance(e, map_pred):
-            return [_evaluate(e.pred, t1) for t1 in _evaluate(e.expr, t)]
-        elif isinstance(e, dot_text):
-            selected = _evaluate(e.expr, t)
-            if isinstance(selected, list):
-                elems = selected
+                for v in children:
+                    memo.pop((id(v), depth + 1), None)
+                s = ('{' if is_dict else '[') + ', '.join(parts) + ('}' if is_dict else ']')
+                memo[key] = s
+                return s
+            s = None
+        else:
+            raise TypeError(f'{type(obj)} cannot be formatted')
+        memo[key] = s
+        return s
+
+    def emit(obj, depth: int):
+        if isinstance(obj, (int, float, str)) or obj is None:
+            write(dumps(obj))
+            return
+        s = flat(obj, depth)
+        memo.pop((id(obj), depth), None)
+        if s is not None:
+            write(s)
+            return
+        elif isinstance(obj, element):
+            write(('\n' + '  '*depth).join(element_lines(obj)))
+            return
+        pad = '\n' + '  '*(depth + 1)
+        if isinstance(obj, dict):
+            write('{')
+            for i, (k, v) in enumerate(obj.items()):
+                write(',' + pad if i else pad)
+                write(dumps(str(k)) + ': ')
+                emit(v, depth + 1)
+            write('\n' + '  '*depth + '}')
+        else:
+            write('[')
+            for i, x in enumerate(obj):
+                write(',' + pad if i else pad)
+                emit(x, depth + 1)
+            write('\n' + '  '*depth + ']')
+
+    emit(obj, 0)
+
+def pretty_format(obj) -> str:
+    """Formats `obj` like `json.dumps(obj, indent=2)`, but with lists and dicts
+    that fit in MAX_LINE_WIDTH columns on one line, and lxml elements as
+    pretty-printed HTML."""
+    parts = []
+    write_pretty(obj, parts.append)
+    return ''.join(parts)
+
+JSON_BACKENDS = ('orjson', 'json')
+
+@functools.lru_cache(maxsize=None)
+def _default_json_backend() -> str:
+    import importlib.util
+    if importlib.util.find_spec('orjson') is not None:
+        return 'orjson'
+    return 'json'
+
+# a string, or a float in the json module's output that orjson writes differently
+_JSON_FLOAT = re.compile(rb'("(?:[^"\\]|\\.)*")|-?Infinity|NaN|(-?)([0-9])(?:\.([0-9]+))?e([-+])0*([0-9]+)')
+_JSON_FLOAT_HINT = re.compile(rb'e[-+](?<=[0-9]e[-+])|Infinity|NaN')
+
+def _orjson_floats(data: bytes) -> bytes:
+    """Rewrites the floats in `data`, the output of the json module, as orjson
+    writes them: NaN and infinities as null, exponents without a plus sign
+    or leading zeros (`1e21` for `1e+21`, `1e-7` for `1e-07`) and numbers
+    from 1e-5 up to 1e-4 without an exponent."""
+    if b'e+' not in data and b'e-' not in data and b'NaN' not in data and b'Infinity' not in data:
+        return data
+    elif _JSON_FLOAT_HINT.search(data) is None:
+        return data
+    def repl(m):
+        string, sign, digit, fraction, exp_sign, exp = m.groups()
+        if string is not None:
+            return string
+        elif digit is None:
+            return b'null'
+        elif exp_sign == b'-' and exp == b'5':
+            return sign + b'0.0000' + digit + (fraction or b'')
+        mantissa = sign + digit + (b'.' + fraction if fraction else b'')
+        return mantissa + b'e' + exp_sign.lstrip(b'+') + exp
+    return _JSON_FLOAT.sub(repl, data)
+
+@functools.lru_cache(maxsize=None)
+def json_encoder(compact: bool = False, backend: T.Optional[str] = None) -> T.Callable[[T.Any], bytes]:
+    """Returns a function encoding a value as UTF-8 JSON, indented by two
+    spaces like `json.dumps(obj, indent=2, ensure_ascii=False)` or, if
+    `compact`, without whitespace. `backend` is orjson if installed and the
+    json module otherwise; both give the same bytes for heq's results,
+    which are made of strings, None, booleans, floats (from XPath
+    functions), lists and dicts. Floats are written as orjson writes them,
+    with NaN and infinities as null, so the output is always valid JSON."""
+    if backend is None:
+        backend = _default_json_backend()
+    if backend == 'orjson':
+        import orjson
+        if compact:
+            return orjson.dumps
+        return functools.partial(orjson.dumps, option=orjson.OPT_INDENT_2)
+    if backend == 'json':
+        if compact:
+            encode = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+        else:
+            encode = json.JSONEncoder(ensure_ascii=False, indent=2).encode
+        return lambda obj: _orjson_floats(encode(obj).encode('utf-8'))
+    raise ValueError(f'unknown JSON backend: {backend}')
+
+def write_json_array(items: T.Iterable, fp: T.BinaryIO, compact: bool = False, backend: T.Optional[str] = None):
+    """Writes `items` to the binary file `fp` as a JSON array, encoding and
+    writing one item at a time; the bytes are those of `json_encoder` applied
+    to `list(items)`."""
+    encode = json_encoder(compact, backend)
+    first = True
+    if compact:
+        for x in items:
+            fp.write(b'[' if first else b',')
+            fp.write(encode(x))
+            first = False
+        fp.write(b'[]' if first else b']')
+        return
+    for x in items:
+        fp.write(b'[\n  ' if first else b',\n  ')
+        fp.write(encode(x).replace(b'\n', b'\n  '))
+        first = False
+    fp.write(b'[]' if first else b'\n]')
+
+def write_json(obj, fp: T.BinaryIO, compact: bool = False, backend: T.Optional[str] = None):
+    """Writes `obj` to the binary file `fp` as `json_encoder` encodes it; a
+    list is written item by item."""
+    if isinstance(obj, list):
+        write_json_array(obj, fp, compact, backend)
+    else:
+        fp.write(json_encoder(compact, backend)(obj))
+
+def write_ndjson(items: T.Iterable, fp: T.BinaryIO, backend: T.Optional[str] = None):
+    """Writes each of `items` to the binary file `fp` as compact JSON on a line of its own."""
+    encode = json_encoder(True, backend)
+    for x in items:
+        fp.write(encode(x))
+        fp.write(b'\n')
+
+def _count_matches(result) -> int:
+    return len(result) if isinstance(result, list) else 1
+
+def _count_nonempty(result) -> int:
+    return 1 if result else 0
+
+_PROFILED = (xpath, css, selector_indexed, dot_text, at_attr)
+
+def _compile(e: Expr, profile: T.Optional['Profile'] = None) -> T.Callable:
+    if profile is not None and isinstance(e, _PROFILED):
+        stats = profile._add(e)
+        func = _compile_node(e, profile)
+        return profile._wrap(stats, func)
+    return _compile_node(e, profile)
+
+def _compile_map(e: map_pred, profile: T.Optional['Profile'] = None) -> T.Tuple[T.Callable, T.Callable]:
+    """Returns functions selecting the context elements and mapping a list of
+    them to an iterator of the values of `e.pred`."""
+    return _compile(e.expr, profile), _compile_apply(e.pred, profile)
+
+def _compile_node(e: Expr, profile: T.Optional['Profile']) -> T.Callable:
+    if isinstance(e, map_pred):
+        select, apply = _compile_map(e, profile)
+        return lambda t: list(apply(select(t)))
+    elif isinstance(e, dot_text):
+        select = _compile(e.expr, profile)
+        consume = _compile_text(e.func, isinstance(e.expr, selector_indexed))
+        return lambda t: consume(select(t))
+    elif isinstance(e, at_attr):
+        name = e.attr
+        if isinstance(e.expr, (xpath, css)):
+            select = _compile_selector(e.expr, 0)
+            if profile is not None:
+                select = profile._wrap(profile._add(e.expr), select)
+        else:
+            select = _compile(e.expr, profile)
+        if isinstance(e.expr, selector_indexed):
+            return lambda t: select(t).attrib.get(name, '')
+        def _at_attr(t):
+            selected = select(t)
+            if len(selected) == 0:
+                return ''
+            return selected[0].attrib.get(name, '')
+        return _at_attr
+    elif isinstance(e, xpath):
+        return compile_xpath(e.xpath)
+    elif isinstance(e, css):
+        return _compile_selector(e)
+    elif isinstance(e, selector_indexed):
+        if profile is not None:
+            profile._add_literal(e.sel)
+        compiled = _compile_selector(e.sel, e.index)
+        return lambda t: _select_nth(compiled, t)
+    elif isinstance(e, dict):
+        return _compile_dict(e, profile)
+    elif isinstance(e, unary_func) and e.name in TEXT_FUNCS:
+        return _compile_text(e.name, True)
+    elif isinstance(e, attr):
+        name = e.name
+        return lambda t: t.attrib.get(name, '')
+    elif isinstance(e, hoisted):
+        func = _compile(e.expr, profile)
+        key = object()
+        def _hoisted(t):
+            values = _hoisted_values.get()
+            if values is None:
+                return func(t)
+            if key not in values:
+                values[key] = func(t)
+            return values[key]
+        return _hoisted
+    raise TypeError(f'{type(e)} is not a value; given: {e}')
+
+TEXT_FUNCS = {
+    'text': None,
+    'strip': str.strip,
+    'normalize': lambda s: ' '.join(s.split()),
+}
+
+def _compile_text(func: str, single: bool) -> T.Callable:
+    """Compiles the text value form `func` into a function of an element, or
+    of a list of elements whose texts are concatenated if not `single`."""
+    import lxml.etree
+    element_text = functools.partial(lxml.etree.tostring, method='text', encoding=str, with_tail=False)
+    if single:
+        get_text = element_text
+    else:
+        get_text = lambda elems: ''.join(map(element_text, elems))
+    post = TEXT_FUNCS[func]
+    if post is None:
+        return get_text
+    return lambda x: post(get_text(x))
+
+def _compile_selector(sel: T.Union[xpath, css], nth: T.Optional[int] = None) -> T.Callable:
+    """Compiles `sel`, or the selection of its `nth` element as a list of at
+    most one element. CSS selectors are looked up in the DocumentIndex of
+    the evaluation, if any and if the index can answer them."""
+    path = sel.to_xpath()
+    compiled = compile_xpath(path if nth is None else _nth_xpath(path, nth))
+    if not isinstance(sel, css) or _index_plan(sel.css) is None:
+        return compiled
+    s = sel.css
+    def _css(t):
+        index = _document_index.get()
+        if index is not None:
+            selected = index.select(s, t)
+            if selected is not None:
+                return selected if nth is None else selected[nth:nth + 1 or None]
+        return compiled(t)
+    return _css
+
+def _consumed_selector(e: Expr) -> T.Optional[T.Union[xpath, css, selector_indexed]]:
+    """Returns the selector whose result `e` is computed from, if any."""
+    if isinstance(e, (xpath, css, selector_indexed)):
+        return e
+    elif isinstance(e, (dot_text, at_attr, map_pred)) and isinstance(e.expr, (xpath, css, selector_indexed)):
+        return e.expr
+    return None
+
+def _compile_consumer(e: Expr, profile: T.Optional['Profile']) -> T.Callable:
+    """Compiles `e` into a function of the result of `_consumed_selector(e)`."""
+    single = isinstance(_consumed_selector(e), selector_indexed)
+    if isinstance(e, dot_text):
+        return _compile_text(e.func, single)
+    elif isinstance(e, at_attr):
+        name = e.attr
+        if single:
+            return lambda elem: elem.attrib.get(name, '')
+        return lambda elems: elems[0].attrib.get(name, '') if len(elems) else ''
+    elif isinstance(e, map_pred):
+        apply = _compile_apply(e.pred, profile)
+        return lambda elems: list(apply(elems))
+    return lambda selected: selected
+
+def _compile_dict(e: dict, profile: T.Optional['Profile']) -> T.Callable:
+    """Compiles a dict so that a selector consumed by several of its fields
+    is evaluated once per context element."""
+    selects, _, build = _compile_dict_parts(e, profile)
+    if not selects:
+        return lambda t: build(t, ())
+    return lambda t: build(t, [select(t) for select in selects])
+
+def _compile_dict_parts(e: dict, profile: T.Optional['Profile'], batch: bool = False) -> T.Tuple[T.List[T.Callable], T.List[T.Optional[T.Callable]], T.Callable]:
+    """Returns the compiled selectors whose results are shared by the fields
+    of `e`, their `_batch_query` (if `batch` is true, otherwise None) and a
+    function building the dict from a context element and the results of
+    the shared selectors for it. With `batch`, every batchable selector is
+    shared even if only one field consumes it."""
+    import collections
+    consumers = collections.defaultdict(list)
+    for v in e.values():
+        sel = _consumed_selector(v)
+        if sel is not None:
+            consumers[sel].append(v)
+    batched = {sel: _batch_query(sel) is not None for sel in consumers} if batch else {}
+    shared = {}
+    selects = []
+    queries = []
+    fields = []
+    for k, v in e.items():
+        sel = _consumed_selector(v)
+        if sel is None or (len(consumers[sel]) < 2 and not batched.get(sel)):
+            fields.append((k, None, _compile(v, profile)))
+            continue
+        stats = profile._add(v) if profile is not None and isinstance(v, (dot_text, at_attr)) else None
+        if sel in shared:
+            if profile is not None:
+                profile._add_literal(sel.sel if isinstance(sel, selector_indexed) else sel)
+        else:
+            sel_stats = profile._add(sel) if profile is not None else None
+            if isinstance(sel, (xpath, css)) and all(isinstance(c, at_attr) for c in consumers[sel]):
+                select = _compile_selector(sel, 0)
             else:
-                elems = [selected]
-            return ''.join(s for t1 in elems for s in t1.itertext())
-        elif isinstance(e, at_attr):
-            selected = _evaluate(e.expr, t)
-            if isinstance(selected, list):
-                if len(selected) == 0:
-                    return ''
-                elem = selected[0]
+                select = _compile_node(sel, profile)
+            wrap = None
+            if sel_stats is not None:
+                select = profile._wrap(sel_stats, select)
+                wrap = functools.partial(profile._wrap, sel_stats)
+            shared[sel] = len(selects)
+            selects.append(select)
+            queries.append(_batch_query(sel, wrap) if batched.get(sel) else None)
+        consume = _compile_consumer(v, profile)
+        if stats is not None:
+            consume = profile._wrap(stats, consume)
+        fields.append((k, shared[sel], consume))
+    def build(t, selected):
+        return {k: f(t) if i is None else f(selected[i]) for k, i, f in fields}
+    return selects, queries, build
+
+BATCH_MIN_ROWS = 8
+BATCH_MAX_MATCHES = 2
+BATCH_MAX_DESCENDANTS = 16
+
+def _compile_apply(e: Expr, profile: T.Optional['Profile']) -> T.Callable[[list], T.Iterator]:
+    """Compiles `e` into a function mapping a list of context elements to an
+    iterator of the values of `e` for each of them. When enabled by
+    `CompiledExpr(..., batch=True)`, for a dict applied to at least
+    BATCH_MIN_ROWS elements, the selectors that `_batch_query` accepts are
+    evaluated once for all the elements rather than once per element.
+    This pays off when the elements are small, so that the cost of an XPath
+    call outweighs that of searching an element's descendants; elements
+    with more than BATCH_MAX_DESCENDANTS descendants on average (judging
+    from the first BATCH_MIN_ROWS) are evaluated one at a time."""
+    if not isinstance(e, dict):
+        func = _compile(e, profile)
+        return lambda rows: map(func, rows)
+    selects, queries, build = _compile_dict_parts(e, profile, batch=True)
+    if not any(queries):
+        return lambda rows: (build(t, [select(t) for select in selects]) for t in rows)
+    count = compile_xpath('count(descendant::*)')
+    def _apply(rows):
+        if not _batch_maps.get() or len(rows) < BATCH_MIN_ROWS or sum(count(t) for t in rows[:BATCH_MIN_ROWS]) > BATCH_MAX_DESCENDANTS * BATCH_MIN_ROWS:
+            return (build(t, [select(t) for select in selects]) for t in rows)
+        index = {row: i for i, row in enumerate(rows)}
+        nested = _any_nested(rows)
+        scope = _common_ancestor(rows)
+        columns = []
+        for select, query in zip(selects, queries):
+            column = query(scope, index, nested) if query is not None else None
+            if column is None:
+                column = [select(t) for t in rows]
+            elif any(c is None for c in column):
+                # the per-element selector raises the IndexError
+                column = [select(t) if c is None else c for t, c in zip(rows, column)]
+            columns.append(column)
+        return map(build, rows, zip(*columns))
+    return _apply
+
+def _common_ancestor(rows: list):
+    """Returns the innermost element containing (or being) each of `rows`,
+    so that a map nested in another searches only its own part of the
+    document."""
+    chain = [rows[0], *rows[0].iterancestors()]
+    depth = {a: i for i, a in enumerate(chain)}
+    top = 0
+    for row in rows:
+        a = row
+        while a not in depth:
+            a = a.getparent()
+        top = max(top, depth[a])
+    return chain[top]
+
+def _any_nested(rows: list) -> bool:
+    """Tells whether any of `rows`, which are in document order, contains
+    another, which is the case iff one contains the next one."""
+    for prev, row in zip(rows, rows[1:]):
+        if row.getparent() is prev.getparent():
+            continue
+        if any(a is prev for a in row.iterancestors()):
+            return True
+    return False
+
+def _batch_query(sel: Expr, wrap: T.Optional[T.Callable] = None) -> T.Optional[T.Callable]:
+    """For a selector that picks out the descendants (and, for CSS, the
+    context element itself) passing a test of their own, returns a function
+    `query(scope, index, nested)` evaluating it for all the context elements
+    in `index` (a dict of their positions) at once: the matches under
+    `scope`, an element containing all of them, are selected with one XPath
+    call and assigned to the context elements they descend from. `nested` tells whether a context element
+    may contain another. The query gives up and returns None if the first
+    BATCH_MIN_ROWS context elements have more than BATCH_MAX_MATCHES matches
+    each on average, as assigning that many matches in Python is slower than
+    selecting them per element.
+    Returns None for other selectors."""
+    if isinstance(sel, selector_indexed):
+        query = _batch_query(sel.sel, wrap)
+        if query is None:
+            return None
+        i = sel.index
+        # None makes the caller fall back to the per-element selector, which raises IndexError
+        def _query_nth(scope, index, nested):
+            buckets = query(scope, index, nested)
+            if buckets is None:
+                return None
+            return [b[i] if -len(b) <= i < len(b) else None for b in buckets]
+        return _query_nth
+    elif isinstance(sel, xpath):
+        path = sel.xpath.strip()
+        if not (path.startswith('.//') and _SIMPLE_XPATH_STEP.fullmatch(path[1:])):
+            return None
+        find = compile_xpath(path)
+        include_self = False
+    elif isinstance(sel, css):
+        if _element_test(sel) is None:
+            return None
+        find = compile_xpath(css_to_xpath(sel.css))
+        include_self = True
+    else:
+        return None
+    if wrap is not None:
+        find = wrap(find)
+    sample = compile_xpath(sel.to_xpath())
+    # a DocumentIndex answers these per element without walking ancestors
+    indexed = isinstance(sel, css) and _index_plan(sel.css) is not None
+    def _query(scope, index, nested):
+        if indexed and _document_index.get() is not None:
+            return None
+        if sum(len(sample(t)) for t in itertools.islice(index, BATCH_MIN_ROWS)) > BATCH_MAX_MATCHES * BATCH_MIN_ROWS:
+            return None
+        buckets = [[] for _ in index]
+        get = index.get
+        for x in find(scope):
+            i = get(x) if include_self else None
+            if i is not None:
+                buckets[i].append(x)
+                if not nested:
+                    continue
+            for a in x.iterancestors():
+                i = get(a)
+                if i is not None:
+                    buckets[i].append(x)
+                    if not nested:
+                        break
+        return buckets
+    return _query
+
+@dataclass
+class SelectorStats:
+    """Profiling numbers of one selector node. `seconds` includes the time
+    spent in nested selectors. `matches` counts selected elements for
+    selectors and non-empty results for `.text` and `@attr`."""
+    node: Expr
+    literal: int
+    calls: int = 0
+    seconds: float = 0.0
+    matches: int = 0
+
+    @property
+    def mean(self) -> float:
+        return self.seconds / self.calls if self.calls else 0.0
+
+class Profile:
+    """Collects SelectorStats for every selector node of the expressions
+    compiled with it. `hook`, if given, is called as
+    `hook(node, seconds, matches)` after each evaluation of a selector node."""
+
+    def __init__(self, hook: T.Optional[T.Callable[[Expr, float, int], None]] = None):
+        self.hook = hook
+        self.stats: T.List[SelectorStats] = []
+        self._literals: T.List[T.Union[xpath, css]] = []
+
+    def _add(self, node: Expr) -> SelectorStats:
+        stats = SelectorStats(node, len(self._literals))
+        self.stats.append(stats)
+        if isinstance(node, (xpath, css)):
+            self._literals.append(node)
+        return stats
+
+    def _add_literal(self, node: T.Union[xpath, css]):
+        self._literals.append(node)
+
+    def _wrap(self, stats: SelectorStats, func: T.Callable) -> T.Callable:
+        import time
+        perf_counter = time.perf_counter
+        count = _count_nonempty if isinstance(stats.node, (dot_text, at_attr)) else _count_matches
+        hook = self.hook
+        def _profiled(t):
+            start = perf_counter()
+            result = func(t)
+            elapsed = perf_counter() - start
+            matches = count(result)
+            stats.calls += 1
+            stats.seconds += elapsed
+            stats.matches += matches
+            if hook is not None:
+                hook(stats.node, elapsed, matches)
+            return result
+        return _profiled
+
+    def _locate(self, source: str) -> T.List[T.Optional[T.Tuple[int, int]]]:
+        locations = []
+        pos = 0
+        for lit in self._literals:
+            if isinstance(lit, css):
+                i = source.find('$`' + lit.css + '`', pos)
             else:
-                elem = selected
-            return elem.attrib.get(e.attr, '')
-        elif isinstance(e, (xpath, css, selector_indexed)):
-            return e.select(t)
-        elif isinstance(e, dict):
-            return {k: _evaluate(v, t) for k, v in e.items()}
-        elif isinstance(e, unary_func) and e.name == 'text':
-            return ''.join(s for s in t.itertext())
-        elif isinstance(e, attr):
-            return t.attrib.get(e.name, '')
-        raise TypeError(f'{type(e)} is not a value; given: {e}')
-    return _evaluate1
-
-def extract(expr: Expr, tree_or_html: T.Union[str, 'lxml.etree._Element']):
-    if isinstance(tree_or_html, str):
+                i = source.find('`' + lit.xpath + '`', pos)
+            if i < 0:
+                locations.append(None)
+                continue
+            pos = i + 1
+            line = source.count('\n', 0, i) + 1
+            locations.append((line, i - (source.rfind('\n', 0, i) + 1) + 1))
+        return locations
+
+    def report(self, source: T.Optional[str] = None) -> str:
+        """Formats the collected numbers as a table, with the line and column
+        of each selector in `source` if the expression was parsed from it."""
+        locations = self._locate(source) if source is not None else []
+        lines = ['{:>9}  {:<44} {:>9} {:>11} {:>10} {:>9}'.format('line:col', 'selector', 'calls', 'total [ms]', 'mean [us]', 'matches')]
+        for stats in self.stats:
+            location = locations[stats.literal] if stats.literal < len(locations) else None
+            lines.append('{:>9}  {:<44} {:>9} {:>11.3f} {:>10.2f} {:>9}'.format(
+                '{}:{}'.format(*location) if location else '-',
+                _describe(stats.node),
+                stats.calls, 1000 * stats.seconds, 1e6 * stats.mean, stats.matches))
+        return '\n'.join(lines)
+
+def _describe(node: Expr) -> str:
+    if isinstance(node, xpath):
+        return '`{}`'.format(node.xpath)
+    elif isinstance(node, css):
+        return '$`{}`'.format(node.css)
+    elif isinstance(node, selector_indexed):
+        return '{}[{}]'.format(_describe(node.sel), node.index)
+    elif isinstance(node, dot_text):
+        return '{}.{}'.format(_describe(node.expr), node.func)
+    elif isinstance(node, at_attr):
+        return '{}@{}'.format(_describe(node.expr), node.attr)
+    elif isinstance(node, map_pred):
+        return '{} / ...'.format(_describe(node.expr))
+    elif isinstance(node, dict):
+        return '{' + ', '.join('{}: {}'.format(k, _describe(v)) for k, v in node.items()) + '}'
+    return repr(node)
+
+_document_index = contextvars.ContextVar('heq_document_index', default=None)
+_hoisted_values = contextvars.ContextVar('heq_hoisted_values', default=None)
+_batch_maps = contextvars.ContextVar('heq_batch_maps', default=False)
+
+def _iter_in_context(context: contextvars.Context, make: T.Callable[[], T.Iterable]) -> T.Iterator:
+    it = context.run(lambda: iter(make()))
+    while True:
+        try:
+            x = context.run(next, it)
+        except StopIteration:
+            return
+        yield x
+
+class CompiledExpr:
+    """`index=True` makes CSS selectors that start with a tag name, id or
+    class be answered from a DocumentIndex of the document, built on first
+    use and shared by all selectors in one evaluation. `batch=True` evaluates
+    the fields of a dict mapped over many small elements set-at-a-time (see
+    `_compile_apply`), which is faster only on some documents."""
+
+    def __init__(self, expr: Expr, profile: T.Optional[Profile] = None, index: bool = False, batch: bool = False):
+        self.expr = expr
+        self.profile = profile
+        self.index = index
+        self.batch = batch
+        if isinstance(expr, map_pred):
+            select, apply = self._iter = _compile_map(expr, profile)
+            self._func = lambda t: list(apply(select(t)))
+        else:
+            self._iter = None
+            self._func = _compile(expr, profile)
+        self._hoisted = any(isinstance(e, hoisted) for e in iter_nodes(expr))
+
+    @functools.cached_property
+    def digest(self) -> str:
+        """Hash of the expression and the heq version, used to key cached results."""
+        import hashlib
+        return hashlib.sha256(f'{__version__}\0{self.expr!r}'.encode('utf-8')).hexdigest()
+
+    @functools.cached_property
+    def prefix_needs(self):
+        return prefix_needs(self.expr)
+
+    @functools.cached_property
+    def prune_plan(self):
+        return prune_plan(self.expr)
+
+    def _context(self, tree) -> contextvars.Context:
+        """Returns the context to evaluate the expression on `tree` in, with the
+        DocumentIndex and the storage for hoisted values of the evaluation."""
+        context = contextvars.copy_context()
+        if self.index:
+            context.run(_document_index.set, DocumentIndex(tree))
+        if self._hoisted:
+            context.run(_hoisted_values.set, {})
+        if self.batch:
+            context.run(_batch_maps.set, True)
+        return context
+
+    def __call__(self, tree):
+        if not self.index and not self._hoisted and not self.batch:
+            return self._func(tree)
+        return self._context(tree).run(self._func, tree)
+
+    def iter(self, tree) -> T.Iterator:
+        """Yields the elements of the result one at a time if the expression is
+        a `selector / value_form` mapping, or the whole result otherwise."""
+        if self._iter is not None:
+            select, apply = self._iter
+            if self.index or self._hoisted or self.batch:
+                return _iter_in_context(self._context(tree), lambda: apply(select(tree)))
+            return apply(select(tree))
+        return iter([self(tree)])
+
+def evaluate(expr: T.Union[Expr, CompiledExpr], profile: T.Optional[Profile] = None, index: T.Optional[bool] = None) -> CompiledExpr:
+    batch = False
+    if isinstance(expr, CompiledExpr):
+        if profile is None and index in (None, expr.index):
+            return expr
+        index = expr.index if index is None else index
+        batch = expr.batch
+        expr = expr.expr
+    return CompiledExpr(expr, profile, bool(index), batch)
+
+SNIFF_SIZE = 1024
+FEED_CHUNK_SIZE = 1 << 20
+
+_BOMS = [(b'\xef\xbb\xbf', 'UTF-8'), (b'\xff\xfe', 'UTF-16LE'), (b'\xfe\xff', 'UTF-16BE')]
+_META_CHARSET = re.compile(rb'''<meta\s[^>]*?charset\s*=\s*["']?\s*([-_.:a-zA-Z0-9]+)''', re.IGNORECASE)
+
+def sniff_encoding(head: bytes, default: str = 'utf-8') -> T.Tuple[str, int]:
+    """Returns the encoding of an HTML document starting with `head`, taken
+    from its byte order mark or `<meta>` charset declaration, and the length
+    of the byte order mark."""
+    import codecs
+    for bom, encoding in _BOMS:
+        if head.startswith(bom):
+            return encoding, len(bom)
+    m = _META_CHARSET.search(head, 0, SNIFF_SIZE)
+    if m is not None:
+        encoding = m.group(1).decode('ascii')
+        try:
+            name = codecs.lookup(encoding).name
+        except LookupError:
+            return default, 0
+        # a document that can declare its encoding in ASCII is not UTF-16
+        if name.startswith('utf-16'):
+            return 'utf-8', 0
+        return encoding, 0
+    return default, 0
+
+_local = threading.local()
+
+def _html_parser(encoding: T.Optional[str]):
+    """Returns a per-thread HTMLParser for `encoding`, or None if lxml does not
+    support the encoding."""
+    import lxml.etree
+    parsers = getattr(_local, 'parsers', None)
+    if parsers is None:
+        parsers = _local.parsers = {}
+    if encoding not in parsers:
+        try:
+            parsers[encoding] = lxml.etree.HTMLParser(remove_blank_text=True, encoding=encoding)
+        except LookupError:
+            parsers[encoding] = None
+    return parsers[encoding]
+
+def _parse_bytes(data: bytes):
+    import lxml.etree
+    encoding, bom = sniff_encoding(data)
+    parser = _html_parser(encoding)
+    if parser is None:
+        return lxml.etree.fromstring(data[bom:].decode(encoding, 'replace'), parser=_html_parser(None))
+    return lxml.etree.fromstring(data[bom:], parser=parser)
+
+def _parse_file(fp):
+    import codecs
+    chunk = fp.read(FEED_CHUNK_SIZE)
+    encoding, bom = sniff_encoding(chunk)
+    parser = _html_parser(encoding)
+    if parser is None:
+        decode = codecs.getincrementaldecoder(encoding)('replace').decode
+        parser = _html_parser(None)
+    else:
+        decode = lambda b, final=False: b
+    chunk = chunk[bom:]
+    try:
+        while chunk:
+            parser.feed(decode(chunk))
+            chunk = fp.read(FEED_CHUNK_SIZE)
+        tail = decode(b'', True)
+        if tail:
+            parser.feed(tail)
+    except BaseException:
+        try:
+            parser.close()
+        except Exception:
+            pass
+        raise
+    return parser.close()
+
+class _Recoder:
+    """Binary file wrapper that re-encodes the content of `fp` from
+    `encoding` to UTF-8."""
+
+    def __init__(self, fp, encoding: str):
+        import codecs
+        self.fp = fp
+        self.decoder = codecs.getincrementaldecoder(encoding)('replace')
+        self.buffer = b''
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self.buffer) < size:
+            chunk = self.fp.read(FEED_CHUNK_SIZE)
+            self.buffer += self.decoder.decode(chunk, not chunk).encode('utf-8')
+            if not chunk:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+def _sniff_file(fp) -> T.Tuple[T.Any, str]:
+    """Returns `fp`, positioned after any byte order mark and re-encoded to
+    UTF-8 if lxml does not support its encoding, and the encoding to parse it
+    with."""
+    if hasattr(fp, 'peek'):
+        head = fp.peek(SNIFF_SIZE)[:SNIFF_SIZE]
+    elif fp.seekable():
+        pos = fp.tell()
+        head = fp.read(SNIFF_SIZE)
+        fp.seek(pos)
+    else:
+        return fp, 'utf-8'
+    encoding, bom = sniff_encoding(head)
+    fp.read(bom)
+    if _html_parser(encoding) is None:
+        return _Recoder(fp, encoding), 'UTF-8'
+    return fp, encoding
+
+def extract_tree(source: T.Union[str, bytes, T.BinaryIO, 'lxml.etree._Element'], expr: T.Union[Expr, CompiledExpr, None] = None):
+    """Parses `source`, which is HTML as str or bytes or a binary file object,
+    and returns the root element. Trees are returned as they are. The
+    encoding of bytes is taken from the byte order mark or the `<meta>`
+    charset declaration, defaulting to UTF-8, and files are fed to the
+    parser in chunks. If `expr` is given and its value only depends on the
+    first matches of some selectors (see `prefix_needs`), bytes and files
+    are only read and parsed up to the end of those matches."""
+    if isinstance(source, str):
         import lxml.etree
-        parser = lxml.etree.HTMLParser(remove_blank_text=True)
-        tree = lxml.etree.fromstring(tree_or_html, parser=parser)
+        return lxml.etree.fromstring(source, parser=_html_parser(None))
+    elif not isinstance(source, (bytes, bytearray, memoryview)) and not hasattr(source, 'read'):
+        return source
+    needs = None
+    if expr is not None:
+        needs = expr.prefix_needs if isinstance(expr, CompiledExpr) else prefix_needs(expr)
+    if needs is not None:
+        if not hasattr(source, 'read'):
+            import io
+            source = io.BytesIO(source)
+        return _parse_prefix(source, needs)
+    elif hasattr(source, 'read'):
+        return _parse_file(source)
+    return _parse_bytes(bytes(source))
+
+RESULT_CACHE_SIZE = 1 << 28
+
+class ResultCache:
+    """On-disk cache of extraction results as compact JSON, keyed by the
+    hash of the document, the hash of the parsed expression and the heq
+    version. Entries are written atomically, so several processes may share
+    a cache directory. When more than `max_size` bytes are stored, the least
+    recently used entries are removed; this is checked after a write with a
+    probability that grows with its size, so that its cost is amortized."""
+
+    def __init__(self, path: T.Union[str, os.PathLike, None] = None, max_size: int = RESULT_CACHE_SIZE):
+        self.path = Path(path) if path is not None else cache_dir() / 'results'
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, compiled: CompiledExpr, data: bytes) -> str:
+        import hashlib
+        return hashlib.sha256(compiled.digest.encode('ascii') + hashlib.sha256(data).digest()).hexdigest()
+
+    def _entry(self, key: str) -> Path:
+        return self.path / key[:2] / (key[2:] + '.json')
+
+    def get(self, key: str) -> T.Optional[bytes]:
+        path = self._entry(key)
+        try:
+            with open(path, 'rb') as fp:
+                data = fp.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, key: str, data: bytes):
+        import random
+        try:
+            _atomic_write(self._entry(key), data)
+        except OSError:
+            return
+        if random.random() * (self.max_size >> 4) < len(data):
+            self.evict()
+
+    def evict(self, max_size: T.Optional[int] = None):
+        """Removes the least recently used entries until at most three
+        quarters of `max_size` (by default that of the cache) are used, if
+        more than `max_size` bytes are."""
+        if max_size is None:
+            max_size = self.max_size
+        entries = []
+        total = 0
+        try:
+            dirs = list(os.scandir(self.path))
+        except FileNotFoundError:
+            return
+        for d in dirs:
+            if not d.is_dir():
+                continue
+            for entry in os.scandir(d.path):
+                if entry.name.endswith('.json'):
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+                    total += st.st_size
+        if total <= max_size:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            if total <= max_size - (max_size >> 2):
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def extract_json(self, compiled: CompiledExpr, source: T.Union[str, bytes, T.BinaryIO], stop_early: bool = False) -> bytes:
+        """Returns the result of `compiled` for `source` as compact JSON, from
+        the cache if possible. Raises TypeError if the result is not JSON.
+        `stop_early` is as for `extract`."""
+        if isinstance(source, str):
+            data = b's' + source.encode('utf-8', 'surrogatepass')
+        else:
+            if hasattr(source, 'read'):
+                source = source.read()
+            data = b'b' + bytes(source)
+        key = self.key(compiled, data)
+        cached = self.get(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        self.misses += 1
+        result = json_encoder(True)(compiled(extract_tree(source, compiled if stop_early else None)))
+        self.put(key, result)
+        return result
+
+    def stats(self) -> str:
+        return f'{self.hits} hits, {self.misses} misses'
+
+def extract(expr: T.Union[Expr, CompiledExpr], tree_or_html: T.Union[str, bytes, T.BinaryIO, 'lxml.etree._Element'], cache: T.Optional[ResultCache] = None, stop_early: bool = False):
+    """Evaluates `expr` on `tree_or_html`. If a `cache` is given, the result
+    for HTML input is looked up in and stored into it, and on a hit the HTML
+    is not parsed at all. With `stop_early`, bytes and files are only parsed
+    as far as the result needs (see `extract_tree`)."""
+    compiled = evaluate(expr)
+    if cache is not None and (isinstance(tree_or_html, (str, bytes, bytearray, memoryview)) or hasattr(tree_or_html, 'read')):
+        return json.loads(cache.extract_json(compiled, tree_or_html, stop_early))
+    return compiled(extract_tree(tree_or_html, compiled if stop_early else None))
+
+def extract_all(exprs: T.Mapping[str, T.Union[Expr, CompiledExpr]], tree_or_html: T.Union[str, bytes, T.BinaryIO, 'lxml.etree._Element'], stop_early: bool = False) -> dict:
+    """Evaluates each of `exprs` on a single parse of `tree_or_html` and
+    returns the results by name. The expressions are compiled together as
+    one dict, so a selector that several of them start with is evaluated
+    once; `CompiledExpr({name: expr, ...})` does the same ahead of time."""
+    combined = CompiledExpr({name: e.expr if isinstance(e, CompiledExpr) else e for name, e in exprs.items()})
+    return combined(extract_tree(tree_or_html, combined if stop_early else None))
+
+_worker_expr = None
+_worker_until = None
+_worker_encode = None
+_worker_cache = None
+_worker_prune = False
+
+def _init_worker(expr: Expr, json_backend: T.Optional[str] = None, stop_early: bool = False, cache: T.Optional[ResultCache] = None, index: bool = False, prune: bool = False, batch: bool = False):
+    global _worker_expr, _worker_until, _worker_encode, _worker_cache, _worker_prune
+    _worker_expr = CompiledExpr(expr, index=index, batch=batch)
+    _worker_until = _worker_expr if stop_early else None
+    _worker_encode = json_encoder(True, json_backend)
+    _worker_cache = cache
+    _worker_prune = prune
+
+def _worker_extract(source):
+    tree = extract_tree(source, _worker_until)
+    if _worker_prune:
+        prune_tree(tree, _worker_expr)
+    return _worker_expr(tree)
+
+def _extract_file(path: str) -> T.Tuple[bytes, T.Optional[bool]]:
+    """Returns the JSON Lines record for `path` and whether its result was
+    found in the cache (None if there is none)."""
+    hit = None
+    try:
+        with open(path, 'rb') as fp:
+            if _worker_cache is None:
+                line = _worker_encode({'file': path, 'result': _worker_extract(fp)})
+            else:
+                hits = _worker_cache.hits
+                result = _worker_cache.extract_json(_worker_expr, fp, _worker_until is not None)
+                hit = _worker_cache.hits > hits
+                line = b'{"file":' + _worker_encode(path) + b',"result":' + result + b'}'
+    except Exception as e:
+        record = {'file': path, 'error': f'{type(e).__name__}: {e}'}
+        line = _worker_encode(record)
+    return line + b'\n', hit
+
+def _extract_doc(html):
+    return _worker_extract(html)
+
+def extract_many(expr: T.Union[Expr, CompiledExpr], docs: T.Iterable, workers: T.Optional[int] = None, executor: str = 'thread', stop_early: bool = False) -> T.Iterator:
+    """Lazily yields `extract(expr, doc, stop_early=stop_early)` for each of `docs`, in order,
+    evaluating up to `workers` documents concurrently in threads or
+    processes. At most `2 * workers` documents are in flight at a time."""
+    import concurrent.futures
+    compiled = evaluate(expr)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if executor == 'thread':
+        pool = concurrent.futures.ThreadPoolExecutor(workers)
+        fn = functools.partial(extract, compiled, stop_early=stop_early)
+    elif executor == 'process':
+        pool = concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(compiled.expr, None, stop_early, None, compiled.index, False, compiled.batch))
+        fn = _extract_doc
     else:
-        tree = tree_or_html
-    return evaluate(expr)(tree)
+        raise ValueError(f'unknown executor: {executor}')
+    return _imap_bounded(pool, fn, docs, 2 * workers)
 
-def main():
+def _imap_bounded(pool, fn, items, limit):
+    import collections
+    with pool:
+        pending = collections.deque()
+        for item in items:
+            if len(pending) >= limit:
+                yield pending.popleft().result()
+            pending.append(pool.submit(fn, item))
+        while pending:
+            yield pending.popleft().result()
+
+async def extract_async(expr: T.Union[Expr, CompiledExpr], doc, executor=None):
+    """Awaitable `extract(expr, doc)` running in `executor` (the event loop's
+    default executor if None)."""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, extract, expr, doc)
+
+_SIMPLE_XPATH_STEP = re.compile(r"""//(\*|[_a-zA-Z][-._0-9a-zA-Z]*)((?:\[@[_a-zA-Z][-._0-9a-zA-Z]*(?:\s*!?=\s*(?:"[^"]*"|'[^']*'))?\])*)""")
+_XPATH_STRING = re.compile(r""""[^"]*"|'[^']*'""")
+_XPATH_ABSOLUTE = re.compile(r"(^|[\[(,|=<>!+\s])/|\bid\s*\(")
+_XPATH_NONLOCAL_AXIS = re.compile(r"\.\.|\b(ancestor|ancestor-or-self|parent|preceding|preceding-sibling|following|following-sibling)\s*::")
+
+def _css_nodes(s: str) -> list:
+    import cssselect
+    nodes = []
+    for sel in cssselect.parse(s):
+        if sel.pseudo_element is not None:
+            nodes.append(sel.pseudo_element)
+        stack = [sel.parsed_tree]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            for name in ('selector', 'subselector'):
+                child = getattr(node, name, None)
+                if child is not None:
+                    stack.append(child)
+    return nodes
+
+def _element_test(sel) -> T.Optional[T.Tuple[T.Optional[str], str]]:
+    """Returns a tag name (None if any tag may match) and an XPath testing
+    whether the context element itself matches `sel`, for selectors that only
+    look at the element's own tag and attributes."""
+    if isinstance(sel, xpath):
+        m = _SIMPLE_XPATH_STEP.fullmatch(sel.xpath.strip())
+        if m is None:
+            return None
+        tag = None if m.group(1) == '*' else m.group(1)
+        return tag, 'self::' + m.group(1) + m.group(2)
+    elif isinstance(sel, css):
+        import cssselect
+        from cssselect import HTMLTranslator
+        intrinsic = (cssselect.parser.Element, cssselect.parser.Class, cssselect.parser.Hash, cssselect.parser.Attrib, cssselect.parser.Negation)
+        nodes = _css_nodes(sel.css)
+        if not all(isinstance(n, intrinsic) for n in nodes):
+            return None
+        tags = {n.element for n in nodes if isinstance(n, cssselect.parser.Element)}
+        tag = None
+        if len(cssselect.parse(sel.css)) == 1 and len(tags) == 1 and None not in tags and '*' not in tags:
+            tag = tags.pop().lower()
+        return tag, HTMLTranslator().css_to_xpath(sel.css, prefix='self::')
+    return None
+
+def _is_subtree_local(sel) -> bool:
+    if isinstance(sel, selector_indexed):
+        return _is_subtree_local(sel.sel)
+    elif isinstance(sel, xpath):
+        path = _XPATH_STRING.sub('""', sel.xpath.strip())
+        if not (path == '.' or path.startswith('./')):
+            return False
+        return not _XPATH_ABSOLUTE.search(path) and not _XPATH_NONLOCAL_AXIS.search(path)
+    elif isinstance(sel, css):
+        import cssselect
+        for n in _css_nodes(sel.css):
+            if isinstance(n, (cssselect.parser.Pseudo, cssselect.parser.Function, str)):
+                return False
+            if isinstance(n, cssselect.parser.CombinedSelector) and n.combinator in ('+', '~'):
+                return False
+        return True
+    return False
+
+def _check_streamable_value(e: Expr):
+    if isinstance(e, dict):
+        for v in e.values():
+            _check_streamable_value(v)
+    elif isinstance(e, (dot_text, at_attr)):
+        if not _is_subtree_local(e.expr):
+            raise ValueError(f'selector may look outside the row element: {e.expr}')
+    elif isinstance(e, map_pred):
+        if not _is_subtree_local(e.expr):
+            raise ValueError(f'selector may look outside the row element: {e.expr}')
+        _check_streamable_value(e.pred)
+    elif isinstance(e, hoisted):
+        raise ValueError(f'value does not depend on the row element: {_describe(e.expr)}')
+    elif not isinstance(e, (unary_func, attr)):
+        raise ValueError(f'value form does not evaluate to JSON: {e}')
+
+def iter_extract(expr: Expr, source) -> T.Iterator:
+    """Evaluate a `selector / value_form` expression while parsing `source` (a
+    filename, a binary file object or bytes, whose encoding is determined as
+    in `extract_tree`), yielding the value for each
+    selected element as soon as it is closed and discarding parsed content
+    that can no longer be selected. Raises ValueError for expressions that
+    cannot be evaluated this way."""
+    if not isinstance(expr, map_pred):
+        raise ValueError('only expressions of the form `selector / value_form` can be streamed')
+    element_test = _element_test(expr.expr)
+    if element_test is None:
+        raise ValueError(f'selector depends on more than the element itself: {expr.expr}')
+    tag, test = element_test
+    _check_streamable_value(expr.pred)
+    if isinstance(source, bytes):
+        import io
+        source = io.BytesIO(source)
+    return _iter_extract(tag, compile_xpath(test), CompiledExpr(expr.pred), source)
+
+def _iter_extract(tag, test, pred, source):
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as fp:
+            yield from _iter_extract(tag, test, pred, fp)
+        return
+    import lxml.etree
+
+    source, encoding = _sniff_file(source)
+    # open matched elements with the index of their slot in `results`
+    open_matches = []
+    results = []
+    events = lxml.etree.iterparse(source, events=('start', 'end'), html=True, remove_blank_text=True, encoding=encoding)
+    for event, elem in events:
+        if event == 'start':
+            if (tag is None or elem.tag == tag) and test(elem):
+                open_matches.append((elem, len(results)))
+                results.append(None)
+            continue
+        if open_matches and open_matches[-1][0] is elem:
+            _, i = open_matches.pop()
+            results[i] = pred(elem)
+            if open_matches:
+                continue
+            yield from results
+            results = []
+        elif open_matches:
+            continue
+        elem.clear()
+        # the root has no parent, but may follow a comment or PI
+        parent = elem.getparent()
+        if parent is not None:
+            while elem.getprevious() is not None:
+                del parent[0]
+
+PREFIX_CHUNK_SIZE = 1 << 14
+
+def prefix_needs(e: Expr) -> T.Optional[T.List[T.Tuple[str, str, int]]]:
+    """Returns a (tag, test, count) triple for each selector that the value of
+    `e`, evaluated on the root, depends on, such that the value is final once
+    the first `count` elements in document order passing the XPath `test`
+    have been closed. Returns None if the value may depend on the whole
+    document, e.g. because it uses every match of a selector (`` `//p`.text ``
+    joins the texts of all of them; `` `//p`[0].text `` does not), and for
+    selectors without a tag name, such as `` $`.x`[0] ``, as testing every
+    element while parsing costs several times a plain parse."""
+    if isinstance(e, dict):
+        needs = []
+        for v in e.values():
+            n = prefix_needs(v)
+            if n is None:
+                return None
+            needs.extend(n)
+        return needs
+    elif isinstance(e, (dot_text, at_attr)):
+        sel, count = e.expr, 1
+        if isinstance(sel, selector_indexed):
+            if sel.index < 0:
+                return None
+            sel, count = sel.sel, sel.index + 1
+        elif isinstance(e, dot_text):
+            return None
+        element_test = _element_test(sel)
+        if element_test is None or element_test[0] is None:
+            return None
+        return [element_test + (count,)]
+    return None
+
+def _parse_prefix(fp, needs):
+    """Parses `fp` like `_parse_file`, but stops reading once `needs` (see
+    `prefix_needs`) are met and returns the tree of the part read so far.
+    Reads start at PREFIX_CHUNK_SIZE and double up to FEED_CHUNK_SIZE, since
+    feeding lxml small chunks is slow."""
+    import codecs
     import lxml.etree
+    options = {'remove_blank_text': True, 'tag': {tag for tag, _, _ in needs}}
+    size = PREFIX_CHUNK_SIZE
+    chunk = fp.read(size)
+    encoding, bom = sniff_encoding(chunk)
+    try:
+        parser = lxml.etree.HTMLPullParser(('start', 'end'), encoding=encoding, **options)
+        decode = lambda b, final=False: b
+    except LookupError:
+        parser = lxml.etree.HTMLPullParser(('start', 'end'), **options)
+        decode = codecs.getincrementaldecoder(encoding)('replace').decode
+    # [tag, test, number of matches still to open, open matches]
+    pending = [[tag, compile_xpath(test), count, []] for tag, test, count in needs]
+    chunk = chunk[bom:]
+    try:
+        while chunk:
+            parser.feed(decode(chunk))
+            for event, elem in parser.read_events():
+                for need in pending:
+                    if event == 'end':
+                        if elem in need[3]:
+                            need[3].remove(elem)
+                    elif need[2] and elem.tag == need[0] and need[1](elem):
+                        need[2] -= 1
+                        need[3].append(elem)
+            pending = [need for need in pending if need[2] or need[3]]
+            if not pending:
+                break
+            size = min(2 * size, FEED_CHUNK_SIZE)
+            chunk = fp.read(size)
+        else:
+            tail = decode(b'', True)
+            if tail:
+                parser.feed(tail)
+    except BaseException:
+        try:
+            parser.close()
+        except Exception:
+            pass
+        raise
+    return parser.close()
+
+PRUNE_TAGS = ('script', 'style', 'noscript', 'template', 'svg')
+
+_PRUNE_XPATH_STEP = r"""//?([_a-zA-Z][-._0-9a-zA-Z]*)(?:\[@[_a-zA-Z][-._0-9a-zA-Z]*(?:\s*!?=\s*(?:"[^"]*"|'[^']*'))?\]|\[contains\(\s*@[_a-zA-Z][-._0-9a-zA-Z]*\s*,\s*(?:"[^"]*"|'[^']*')\s*\)\])*"""
+_PRUNE_XPATH = re.compile(r'(\()?\.?((?:{})+)(?(1)\)\[[0-9]+\])'.format(_PRUNE_XPATH_STEP))
 
+def _selector_tags(sel, context: T.FrozenSet[str]) -> T.FrozenSet[str]:
+    """Returns the tags of the elements that `sel` may select, for selectors
+    that only test the tags and attributes of elements and their ancestors,
+    and raises ValueError for others."""
+    if isinstance(sel, selector_indexed):
+        return _selector_tags(sel.sel, context)
+    elif isinstance(sel, xpath):
+        path = sel.xpath.strip()
+        if path == '.':
+            return context
+        m = _PRUNE_XPATH.fullmatch(path)
+        if m is None:
+            raise ValueError(f'selector may depend on positions, siblings or text: {_describe(sel)}')
+        return frozenset([re.findall(_PRUNE_XPATH_STEP, m.group(2))[-1]])
+    elif isinstance(sel, css):
+        import cssselect
+        for n in _css_nodes(sel.css):
+            if isinstance(n, (cssselect.parser.Pseudo, cssselect.parser.Function, str)) or isinstance(n, cssselect.parser.CombinedSelector) and n.combinator not in (' ', '>'):
+                raise ValueError(f'selector may depend on positions, siblings or text: {_describe(sel)}')
+        tags = set()
+        for s in cssselect.parse(sel.css):
+            node = s.parsed_tree
+            if isinstance(node, cssselect.parser.CombinedSelector):
+                node = node.subselector
+            while not isinstance(node, cssselect.parser.Element):
+                node = node.selector
+            if node.element in (None, '*'):
+                raise ValueError(f'selector may match any tag: {_describe(sel)}')
+            tags.add(node.element.lower())
+        return frozenset(tags)
+    raise ValueError(f'not a selector: {sel}')
+
+def _prune_analysis(e: Expr, context: T.FrozenSet[str], selected: set, read: set):
+    """Adds the tags of the elements that `e` selects to `selected` and of
+    those whose text or markup it reads to `read`."""
+    if isinstance(e, dict):
+        for v in e.values():
+            _prune_analysis(v, context, selected, read)
+    elif isinstance(e, map_pred):
+        tags = _selector_tags(e.expr, context)
+        selected.update(tags)
+        _prune_analysis(e.pred, tags, selected, read)
+    elif isinstance(e, (dot_text, at_attr)):
+        tags = _selector_tags(e.expr, context)
+        selected.update(tags)
+        if isinstance(e, dot_text):
+            read.update(tags)
+    elif isinstance(e, (xpath, css, selector_indexed)):
+        tags = _selector_tags(e, context)
+        selected.update(tags)
+        read.update(tags)
+    elif isinstance(e, unary_func):
+        read.update(context)
+    elif isinstance(e, hoisted):
+        _prune_analysis(e.expr, context, selected, read)
+    elif not isinstance(e, attr):
+        raise ValueError(f'{type(e)} is not a value; given: {e}')
+
+def prune_plan(expr: Expr) -> T.Tuple[T.Tuple[str, ...], T.Tuple[str, ...], T.Tuple[str, ...]]:
+    """Returns the tags of PRUNE_TAGS that may be pruned for `expr`, the tags
+    of the elements `expr` may select and the tags of those whose text or
+    markup it reads. An element with a prunable tag can be removed without
+    changing the value of `expr` if it contains no element with a selected
+    tag and is not inside one with a read tag. Raises ValueError if this
+    cannot be decided because a selector may depend on element positions,
+    siblings or text, or may select any tag."""
+    selected, read = set(), set()
+    _prune_analysis(expr, frozenset(['html']), selected, read)
+    tags = tuple(tag for tag in PRUNE_TAGS if tag not in selected)
+    if not tags:
+        raise ValueError('every prunable tag may be selected')
+    return tags, tuple(sorted(selected)), tuple(sorted(read))
+
+def prune_tree(tree, expr: T.Union[Expr, CompiledExpr]) -> int:
+    """Removes the subtrees of `tree` that `prune_plan(expr)` allows to remove,
+    keeping their tail text, and returns how many were removed. Raises
+    ValueError if pruning is not known to be safe for `expr`."""
+    tags, selected, read = expr.prune_plan if isinstance(expr, CompiledExpr) else prune_plan(expr)
+    removed = []
+    for elem in tree.iter(*tags):
+        if read and next(elem.iterancestors(*read), None) is not None:
+            continue
+        if len(elem) and selected and next(elem.iterdescendants(*selected), None) is not None:
+            continue
+        removed.append(elem)
+    for elem in reversed(removed):
+        parent = elem.getparent()
+        if elem.tail:
+            prev = elem.getprevious()
+            if prev is not None:
+                prev.tail = (prev.tail or '') + elem.tail
+            else:
+                parent.text = (parent.text or '') + elem.tail
+        parent.remove(elem)
+    return len(removed)
+
+_XPATH_PREDICATE = re.compile(r'\[[^\[\]]*\]')
+# steps after predicates have been replaced by \0
+_XPATH_STEPS = re.compile(r'(?:\s*//?\s*[-\w.*@:]+(?:\s*\(\s*(?:"")?\s*\))?(?:\s*\0)*)+\s*')
+
+def _is_location_path(path: str) -> bool:
+    """Tells whether `path`, an XPath with string literals blanked and
+    predicates replaced by \0, is an absolute location path, possibly in
+    parentheses and followed by predicates and further steps, rather than
+    e.g. a comparison or a union, which may have relative operands."""
+    path = path.strip()
+    if not path.startswith('('):
+        return _XPATH_STEPS.fullmatch(path) is not None
+    depth = 0
+    for i, c in enumerate(path):
+        depth += (c == '(') - (c == ')')
+        if depth == 0:
+            break
+    else:
+        return False
+    rest = path[i + 1:].lstrip().lstrip('\0')
+    return _is_location_path(path[1:i]) and (not rest.strip() or _XPATH_STEPS.fullmatch(rest) is not None)
+
+def _is_absolute(sel) -> bool:
+    if isinstance(sel, selector_indexed):
+        return _is_absolute(sel.sel)
+    elif isinstance(sel, xpath):
+        path = _XPATH_STRING.sub('""', sel.xpath)
+        while '[' in path:
+            path, n = _XPATH_PREDICATE.subn('\0', path)
+            if not n:
+                return False
+        return ']' not in path and _is_location_path(path)
+    return False
+
+def _is_context_free(e: Expr) -> bool:
+    """Tells whether the value of `e` is the same for every element of a
+    document it may be evaluated for."""
+    if isinstance(e, (xpath, css, selector_indexed)):
+        return _is_absolute(e)
+    elif isinstance(e, (dot_text, at_attr, map_pred)):
+        return _is_context_free(e.expr)
+    elif isinstance(e, dict):
+        return bool(e) and all(_is_context_free(v) for v in e.values())
+    return isinstance(e, hoisted)
+
+def _hoist(e: Expr, in_map: bool, found: list) -> Expr:
+    if in_map and not isinstance(e, hoisted) and _is_context_free(e):
+        found.append(e)
+        return hoisted(e)
+    elif isinstance(e, map_pred):
+        return map_pred(_hoist(e.expr, in_map, found), _hoist(e.pred, True, found))
+    elif isinstance(e, dict):
+        return {k: _hoist(v, in_map, found) for k, v in e.items()}
+    return e
+
+def hoist(expr: Expr) -> Expr:
+    """Returns `expr` with each value inside a `/` mapping that does not depend
+    on the element mapped over, such as `` `//title`[0].text `` or
+    `` `//a` / @href ``, wrapped in `hoisted`, so that it is evaluated once
+    per evaluation of the whole expression rather than once per element.
+    The result is the same, but the elements share the hoisted value."""
+    return _hoist(expr, False, [])
+
+def lint(expr: Expr) -> T.List[str]:
+    """Returns a warning for each value that `hoist` would hoist out of a
+    `/` mapping. Absolute XPath selectors inside a mapping are a common
+    mistake for relative ones (`` `//a` `` for `` `.//a` ``), and otherwise
+    make the evaluation quadratic in the size of the document."""
+    found = []
+    _hoist(expr, False, found)
+    return [f'{_describe(e)} does not depend on the element it is evaluated for, but is evaluated again for each element of the enclosing `/` mapping' for e in found]
+
+_SCRIPT_NAME = re.compile(r'([_a-zA-Z][-_0-9a-zA-Z]*)=(.*)', re.DOTALL)
+
+def _split_name(spec: str) -> T.Tuple[T.Optional[str], str]:
+    m = _SCRIPT_NAME.fullmatch(spec)
+    if m is None or os.path.exists(spec):
+        return None, spec
+    return m.group(1), m.group(2)
+
+def _read_input_list(fp) -> T.List[str]:
+    return [line.rstrip('\r\n') for line in fp if line.strip()]
+
+def _run_batch(expr: Expr, paths: T.List[str], fp, jobs: int, ordered: bool = True, chunksize: int = 8, json_backend: T.Optional[str] = None, stop_early: bool = False, cache: T.Optional[ResultCache] = None, index: bool = False, prune: bool = False, batch: bool = False):
+    initargs = (expr, json_backend, stop_early, cache, index, prune, batch)
+    if jobs <= 1:
+        _init_worker(*initargs)
+        for path in paths:
+            fp.write(_extract_file(path)[0])
+        return
+    import multiprocessing
+    with multiprocessing.Pool(jobs, initializer=_init_worker, initargs=initargs) as pool:
+        imap = pool.imap if ordered else pool.imap_unordered
+        for line, hit in imap(_extract_file, paths, chunksize):
+            fp.write(line)
+            # the workers count in their own copies of the cache
+            if hit is not None:
+                cache.hits += hit
+                cache.misses += not hit
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _compile_source(source: T.Union[str, T.Tuple[T.Tuple[str, str], ...]], parser: T.Optional[str] = None, index: bool = False, optimize: bool = False) -> CompiledExpr:
+    """Compiles a script, or a tuple of (name, script) pairs to evaluate
+    together as in `extract_all`."""
+    if isinstance(source, str):
+        expr = parse(source, parser)
+    else:
+        expr = {name: parse(s, parser) for name, s in source}
+    return CompiledExpr(hoist(expr) if optimize else expr, index=index)
+
+class Server:
+    """Evaluates the requests of `heq --serve`, keeping the expressions it
+    has compiled and the named ones it has been given. Requests and responses
+    are JSON objects, one per line. A request either defines named scripts,
+    as `{"define": {name: script, ...}}`, or evaluates a script on a document:
+
+        {"expr": script or {name: script, ...}, or "name": name,
+         "path": file, or "html": str, or "html_base64": bytes in base64,
+         "parser", "index", "optimize", "prune", "stop_early": options,
+         "ndjson": true to get the elements of a list result as "results"}
+
+    The response carries "result" (or "results") and "time", the seconds
+    spent in compiling, parsing and evaluating, or "error". The "id" of a
+    request, if any, is copied to its response."""
+
+    def __init__(self, parser: T.Optional[str] = None):
+        self.parser = parser
+        self.named: T.Dict[str, T.Union[str, T.Tuple[T.Tuple[str, str], ...]]] = {}
+
+    @staticmethod
+    def _source_key(source):
+        if isinstance(source, dict):
+            return tuple(source.items())
+        elif isinstance(source, str):
+            return source
+        raise TypeError(f'script must be a string or an object of strings; given: {source!r}')
+
+    def define(self, scripts: T.Mapping[str, T.Union[str, T.Mapping[str, str]]]):
+        keys = {name: self._source_key(source) for name, source in scripts.items()}
+        for key in keys.values():
+            _compile_source(key, self.parser)
+        self.named.update(keys)
+
+    def handle(self, request: dict) -> dict:
+        import time
+        perf_counter = time.perf_counter
+        if 'define' in request:
+            self.define(request['define'])
+            return {'defined': sorted(request['define'])}
+        start = perf_counter()
+        if 'name' in request:
+            if request['name'] not in self.named:
+                raise KeyError(f'no script named {request["name"]!r}')
+            key = self.named[request['name']]
+        else:
+            key = self._source_key(request.get('expr'))
+        compiled = _compile_source(key, request.get('parser') or self.parser, bool(request.get('index')), bool(request.get('optimize')))
+        compiled_at = perf_counter()
+        until = compiled if request.get('stop_early') else None
+        if 'path' in request:
+            with open(request['path'], 'rb') as fp:
+                tree = extract_tree(fp, until)
+        elif 'html_base64' in request:
+            import base64
+            tree = extract_tree(base64.b64decode(request['html_base64']), until)
+        elif isinstance(request.get('html'), str):
+            tree = extract_tree(request['html'], until)
+        else:
+            raise ValueError('one of "path", "html" and "html_base64" must be given')
+        if request.get('prune'):
+            try:
+                prune_tree(tree, compiled)
+            except ValueError:
+                pass
+        parsed_at = perf_counter()
+        if request.get('ndjson'):
+            response = {'results': list(compiled.iter(tree))}
+        else:
+            response = {'result': compiled(tree)}
+        response['time'] = {'compile': compiled_at - start, 'parse': parsed_at - compiled_at, 'evaluate': perf_counter() - parsed_at}
+        return response
+
+    def serve(self, rfile: T.BinaryIO, wfile: T.BinaryIO):
+        """Answers the requests read from `rfile` until it ends."""
+        encode = json_encoder(True)
+        for line in rfile:
+            if not line.strip():
+                continue
+            request = {}
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise TypeError('request must be a JSON object')
+                response = self.handle(request)
+            except Exception as e:
+                response = {'error': f'{type(e).__name__}: {e}'}
+            if isinstance(request, dict) and 'id' in request:
+                response = {'id': request['id'], **response}
+            try:
+                data = encode(response)
+            except TypeError as e:
+                data = encode({'id': response['id'], 'error': f'{type(e).__name__}: {e}'} if 'id' in response else {'error': f'{type(e).__name__}: {e}'})
+            wfile.write(data + b'\n')
+            wfile.flush()
+
+def serve_unix(server: Server, path: str):
+    """Serves `server` on the Unix socket `path`, with a thread per connection,
+    until interrupted."""
+    import socket
+    import socketserver
+    if os.path.exists(path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(path)
+            except OSError:
+                os.unlink(path)
+            else:
+                raise OSError(f'a server is already listening on {path}')
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            server.serve(self.rfile, self.wfile)
+
+    with socketserver.ThreadingUnixStreamServer(path, Handler) as unix_server:
+        unix_server.daemon_threads = True
+        try:
+            unix_server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(path)
+
+class Client:
+    """Connection to a `heq --serve` server on the Unix socket `path`."""
+
+    def __init__(self, path: str):
+        import socket
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(path)
+        except BaseException:
+            self.sock.close()
+            raise
+        self.rfile = self.sock.makefile('rb')
+
+    def request(self, **request) -> dict:
+        """Sends `request` (see `Server`) and returns the response."""
+        self.sock.sendall(json_encoder(True)(request) + b'\n')
+        line = self.rfile.readline()
+        if not line:
+            raise ConnectionError('the server closed the connection')
+        return json.loads(line)
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _client_request(args, scripts) -> T.Optional[dict]:
+    """Returns the request evaluating the command line `args` on a server, or
+    None if the server cannot do what they ask for."""
+    if args.debug or args.profile or args.stream or args.show_xpath or args.cache or args.batch_maps or args.input_list or len(args.input or []) > 1:
+        return None
+    if args.EXPR:
+        expr = args.EXPR
+    elif len(scripts) == 1 and scripts[0][0] == 'file' and _split_name(scripts[0][1])[0] is None:
+        expr = Path(scripts[0][1]).read_text(encoding='utf-8')
+    else:
+        expr = {}
+        for kind, spec in scripts:
+            name, value = _split_name(spec)
+            if kind == 'file':
+                name = name or Path(value).stem
+                value = Path(value).read_text(encoding='utf-8')
+            if name is None or name in expr:
+                return None
+            expr[name] = value
+    request = {'expr': expr, 'parser': args.parser, 'index': args.index, 'optimize': args.optimize,
+               'prune': args.prune, 'stop_early': args.stop_early, 'ndjson': args.ndjson}
+    if args.input:
+        request['path'] = os.path.abspath(args.input[0])
+    else:
+        import base64
+        request['html_base64'] = base64.b64encode(sys.stdin.buffer.read()).decode('ascii')
+    return request
+
+def _serve_main(parser, args, scripts):
+    if args.EXPR:
+        parser.print_help()
+        print('EXPR cannot be given with --serve; use --expr NAME=EXPR', file=sys.stderr)
+        sys.exit(1)
+    server = Server(args.parser)
+    named = {}
+    for kind, spec in scripts:
+        name, value = _split_name(spec)
+        if kind == 'file':
+            name = name or Path(value).stem
+            value = Path(value).read_text(encoding='utf-8')
+        elif name is None:
+            print(f'heq: --expr must be given as NAME=EXPR: {spec}', file=sys.stderr)
+            sys.exit(1)
+        named[name] = value
+    server.define(named)
+    if args.serve == '-':
+        server.serve(sys.stdin.buffer, sys.stdout.buffer)
+    else:
+        serve_unix(server, args.serve)
+
+def _connect_main(args, scripts):
+    """Evaluates on the server if possible, and exits unless evaluation should
+    continue locally."""
+    try:
+        client = Client(args.connect)
+    except OSError as e:
+        print(f'heq: cannot connect to {args.connect} ({e}); evaluating locally', file=sys.stderr)
+        return
+    with client:
+        request = _client_request(args, scripts)
+        if request is None:
+            return
+        response = client.request(**request)
+    if 'error' in response:
+        print(f'heq: {response["error"]}', file=sys.stderr)
+        sys.exit(1)
+    if args.ndjson:
+        _write_output(args, iter(response['results']), None)
+    else:
+        _write_output(args, None, response['result'])
+    sys.exit(0)
+
+def _write_output(args, results, out):
+    if args.debug and results is None:
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8', newline='', buffering=OUTPUT_BUFFER_SIZE) as fp:
+                write_pretty(out, fp.write)
+        else:
+            write_pretty(out, sys.stdout.write)
+            sys.stdout.write('\n')
+        return
+    if args.output:
+        fp = open(args.output, 'wb', buffering=OUTPUT_BUFFER_SIZE)
+    else:
+        sys.stdout.flush()
+        fp = sys.stdout.buffer
+    try:
+        if results is not None and args.ndjson:
+            write_ndjson(results, fp, args.json_backend)
+        elif results is not None:
+            write_json_array(results, fp, args.compact, args.json_backend)
+        else:
+            write_json(out, fp, args.compact, args.json_backend)
+        if not args.output and not args.ndjson:
+            fp.write(b'\n')
+    finally:
+        if args.output:
+            fp.close()
+        else:
+            fp.flush()
+
+def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--file', '-f', help='script source file')
+    parser.add_argument('--file', '-f', dest='scripts', action='append', type=lambda s: ('file', s), help='script source file, optionally as NAME=PATH; may be repeated, and the output is then an object of the results by name (NAME defaults to the file name without extension)')
+    parser.add_argument('--expr', '-e', dest='scripts', action='append', type=lambda s: ('expr', s), help='script as NAME=EXPR; may be repeated and combined with --file')
+    parser.add_argument('--no-script-cache', action='store_true', help='always parse --file instead of using its precompiled form')
     parser.add_argument('--output', '-o', help='output file')
-    parser.add_argument('--input', '-i', help='input file (stdin is used if not given)')
+    parser.add_argument('--input', '-i', action='append', help='input file (stdin is used if not given); may be repeated for batch mode')
+    parser.add_argument('--input-list', help='file listing input files, one per line ("-" for stdin); implies batch mode')
+    parser.add_argument('--jobs', '-j', type=int, help='number of worker processes in batch mode (default: number of CPUs)')
+    parser.add_argument('--unordered', action='store_true', help='emit batch results as they complete instead of in input order')
+    parser.add_argument('--parser', choices=['parsimonious', 'rd'], help='expression parser (parsimonious if installed, otherwise rd)')
     parser.add_argument('--debug', '-d', action='store_true')
+    parser.add_argument('--ndjson', action='store_true', help='write one compact JSON value per line for each element of a list result')
+    parser.add_argument('--compact', '-c', action='store_true', help='write JSON without whitespace')
+    parser.add_argument('--json-backend', choices=JSON_BACKENDS, help='JSON encoder (orjson if installed, otherwise json); the output is the same with either')
+    parser.add_argument('--stream', action='store_true', help='evaluate `selector / value_form` while parsing the input, emitting each result as its element closes')
+    parser.add_argument('--prune', action='store_true', help='remove script, style, svg and similar subtrees that cannot affect the result before evaluation')
+    parser.add_argument('--stop-early', action='store_true', help='stop reading the input once the first matches the result depends on are complete, e.g. for `$`title`[0].text`; slower than reading everything if they come late or not at all')
+    parser.add_argument('--optimize', '-O', action='store_true', help='evaluate values inside a `/` mapping that do not depend on the mapped element, e.g. `//title`[0].text, once instead of once per element')
+    parser.add_argument('--cache', action='store_true', help='cache results under $HEQ_CACHE_DIR/results, keyed by the input bytes and the expression, and reuse them without parsing the input')
+    parser.add_argument('--cache-size', type=int, default=RESULT_CACHE_SIZE >> 20, metavar='MIB', help='size limit of the result cache in MiB (default: %(default)s)')
+    parser.add_argument('--cache-stats', action='store_true', help='print the hits and misses of the result cache to stderr')
+    parser.add_argument('--profile', action='store_true', help='print the time spent in and the matches of each selector to stderr')
+    parser.add_argument('--index', action='store_true', help='answer CSS selectors starting with a tag name, #id or .class from an index of the document')
+    parser.add_argument('--batch-maps', action='store_true', help='evaluate the fields of a `/` mapping over many small elements with one query per field for all elements; faster only on some documents')
+    parser.add_argument('--show-xpath', action='store_true', help='print the XPath translation of each CSS selector to stderr')
+    parser.add_argument('--serve', metavar='SOCKET', help='run as a server answering JSON requests, one per line, on the Unix socket SOCKET ("-" for stdin and stdout); scripts given with --file/--expr are available by name')
+    parser.add_argument('--connect', metavar='SOCKET', default=os.environ.get('HEQ_SERVER') or None, help='evaluate on the server listening on SOCKET, falling back to evaluating locally if it cannot be reached (default: $HEQ_SERVER)')
     parser.add_argument('EXPR', nargs='?', help='script')
     args = parser.parse_args()
-    if bool(args.file) ==  bool(args.EXPR):
+    scripts = args.scripts or []
+    if args.serve:
+        _serve_main(parser, args, scripts)
+        return
+    if bool(scripts) == bool(args.EXPR):
         parser.print_help()
-        print('Exactly one of --file and EXPR must be given', file=sys.stderr)
+        print('Exactly one of --file/--expr and EXPR must be given', file=sys.stderr)
         sys.exit(1)
-    if args.file:
-        with open(args.file, 'rb') as fp:
-            source = fp.read().decode('utf-8')
+    if args.connect:
+        _connect_main(args, scripts)
+    source = args.EXPR
     if args.EXPR:
-        source = args.EXPR
-    expr = parse(source)
-    if args.input:
-        with open(args.input, 'rb') as fp:
-            html = fp.read().decode('utf-8')
+        expr = parse(args.EXPR, args.parser)
+    elif len(scripts) == 1 and scripts[0][0] == 'file' and _split_name(scripts[0][1])[0] is None:
+        source = Path(scripts[0][1]).read_text(encoding='utf-8') if args.profile else None
+        expr = load_script(scripts[0][1], use_cache=not args.no_script_cache, parser=args.parser)
     else:
-        html = sys.stdin.read()
-    out = extract(expr, html)
-    if args.debug:
-        format_func = pretty_format
-    else:
-        format_func = lambda x: json.dumps(x, indent=2, ensure_ascii=False)
-    if args.output:
-        with open(args.output, 'wb') as fp:
-            fp.write(format_func(out).encode('utf-8'))
+        expr = {}
+        for kind, spec in scripts:
+            name, value = _split_name(spec)
+            if kind == 'file':
+                script = load_script(value, use_cache=not args.no_script_cache, parser=args.parser)
+                name = name or Path(value).stem
+            elif name is None:
+                print(f'heq: --expr must be given as NAME=EXPR: {spec}', file=sys.stderr)
+                sys.exit(1)
+            else:
+                script = parse(value, args.parser)
+            if name in expr:
+                print(f'heq: duplicate output name: {name}', file=sys.stderr)
+                sys.exit(1)
+            expr[name] = script
+    if args.show_xpath:
+        for sel in iter_selectors(expr):
+            if isinstance(sel, css):
+                print('$`{}` => {}'.format(sel.css, sel.to_xpath()), file=sys.stderr)
+    if args.optimize:
+        expr = hoist(expr)
     else:
-        print(format_func(out))
+        for warning in lint(expr):
+            print(f'heq: warning: {warning}; --optimize evaluates it once', file=sys.stderr)
+    inputs = list(args.input or [])
+    if args.input_list:
+        if args.input_list == '-':
+            inputs.extend(_read_input_list(sys.stdin))
+        else:
+            with open(args.input_list, encoding='utf-8') as fp:
+                inputs.extend(_read_input_list(fp))
+    cache = ResultCache(max_size=args.cache_size << 20) if args.cache else None
+    if len(inputs) > 1 or args.input_list:
+        for option in ['debug', 'stream', 'profile']:
+            if getattr(args, option):
+                print(f'heq: --{option} is not supported with several inputs; ignoring it', file=sys.stderr)
+        prune = args.prune
+        if prune:
+            try:
+                prune_plan(expr)
+            except ValueError as e:
+                print(f'heq: cannot prune for this expression ({e}); keeping the whole documents', file=sys.stderr)
+                prune = False
+        jobs = args.jobs or os.cpu_count() or 1
+        options = dict(ordered=not args.unordered, json_backend=args.json_backend, stop_early=args.stop_early, cache=cache, index=args.index, prune=prune, batch=args.batch_maps)
+        if args.output:
+            with open(args.output, 'wb', buffering=OUTPUT_BUFFER_SIZE) as fp:
+                _run_batch(expr, inputs, fp, jobs, **options)
+        else:
+            _run_batch(expr, inputs, sys.stdout.buffer, jobs, **options)
+        if args.cache_stats and cache is not None:
+            print(f'heq: result cache: {cache.stats()}', file=sys.stderr)
+        return
+    input_path = inputs[0] if inputs else None
+    results = out = profile = None
+    if args.stream and not args.debug and not args.profile and cache is None:
+        try:
+            results = iter_extract(expr, input_path or sys.stdin.buffer)
+        except ValueError as e:
+            print(f'heq: cannot stream this expression ({e}); reading the whole document', file=sys.stderr)
+    if results is None and cache is not None and not args.debug and not args.profile:
+        compiled = CompiledExpr(expr, index=args.index, batch=args.batch_maps)
+        if input_path:
+            with open(input_path, 'rb') as fp:
+                out = json.loads(cache.extract_json(compiled, fp, args.stop_early))
+        else:
+            out = json.loads(cache.extract_json(compiled, sys.stdin.buffer, args.stop_early))
+        if args.ndjson:
+            results = iter(out) if isinstance(expr, map_pred) else iter([out])
+    elif results is None:
+        profile = Profile() if args.profile else None
+        compiled = CompiledExpr(expr, profile, index=args.index, batch=args.batch_maps)
+        until = compiled if args.stop_early else None
+        if input_path:
+            with open(input_path, 'rb') as fp:
+                tree = extract_tree(fp, until)
+        else:
+            tree = extract_tree(sys.stdin.buffer, until)
+        if args.prune:
+            try:
+                prune_tree(tree, compiled)
+            except ValueError as e:
+                print(f'heq: cannot prune for this expression ({e}); keeping the whole document', file=sys.stderr)
+        if args.ndjson and not args.debug:
+            results = compiled.iter(tree)
+        else:
+            out = compiled(tree)
+    _write_output(args, results, out)
+    if profile is not None:
+        print(profile.report(source), file=sys.stderr)
+    if args.cache_stats and cache is not None:
+        print(f'heq: result cache: {cache.stats()}', file=sys.stderr)
 
 if __name__ == '__main__':
     main()
@@ -1,14 +1,16 @@
+import re
 from setuptools import setup
 
 from pathlib import Path
 this_directory = Path(__file__).parent
 long_description = (this_directory / 'README.md').read_text()
+version = re.search(r"^__version__ = '(.+)'$", (this_directory / 'heq.py').read_text(), re.M).group(1)
 
 repo_url = 'https://github.com/atodekangae/heq'
 
 setup(
     name='heq',
-    version='0.0.3',
+    version=version,
     url=repo_url,
     description="Yet another 'jq for HTML'",
     long_description=long_description,
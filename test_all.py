@@ -1,6 +1,7 @@
 import sys
 from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent))
+import heq
 from heq import parse, extract, xpath, css, text, attr
 import re
 import json
@@ -283,7 +284,10 @@ def test_extract(pass_tree):
         '/link2'
     )
 
-def test_parse():
+@pytest.mark.parametrize('parser', ['parsimonious', 'rd'])
+def test_parse(parser):
+    def parse(s):
+        return heq.parse(s, parser)
     assert parse('`x` / {}') == xpath('x') / {}
     assert parse('text') == text
     assert parse('`x` / text') == xpath('x') / text
@@ -330,7 +334,8 @@ def test_parse():
     assert parse('`//input`[5] @name') == xpath('//input')[5] @ 'name'
     assert parse('$`input`[7] @name') == css('input')[7] @ 'name'
 
-def test_readme_examples():
+@pytest.mark.parametrize('parser', ['parsimonious', 'rd'])
+def test_readme_examples(parser):
     readme = (Path(__file__).parent / 'README.md').read_text()
     target_html_pat = re.compile(r'''### Target HTML
 ```html
@@ -350,7 +355,682 @@ def test_readme_examples():
         count += 1
         num, expr, expected_json = m.groups()
         expected = json.loads(expected_json)
-        assert extract(parse(expr), target_html) == expected
+        assert extract(parse(expr, parser), target_html) == expected
         last_num = int(num)
     assert count > 0
     assert count == last_num
+
+def test_xpath_cache():
+    from heq import compile_xpath
+    tree = lxml.etree.HTML('<ul><li>a</li><li>b</li><li>c</li></ul>')
+    before = compile_xpath.cache_info()
+    assert extract(xpath('//li') / xpath('.').text, tree) == ['a', 'b', 'c']
+    after = compile_xpath.cache_info()
+    assert after.misses - before.misses <= 2
+    assert after.hits - before.hits >= 2
+    assert compile_xpath('//li') is compile_xpath('//li')
+
+def test_css_translation():
+    from heq import css_to_xpath, iter_selectors
+    assert css('li.x').to_xpath() == css_to_xpath('li.x')
+    assert css('li').to_xpath() == 'descendant-or-self::li'
+    assert xpath('//li').to_xpath() == '//li'
+    tree = lxml.etree.HTML('<ul><li>a</li><LI>b</LI></ul>')
+    before = css_to_xpath.cache_info()
+    assert extract(css('ul') / (css('LI') / text), tree) == [['a', 'b']]
+    assert css_to_xpath.cache_info().misses - before.misses <= 2
+    expr = css('ul') / {'a': xpath('.//li')[0].text, 'b': css('li') @ 'x'}
+    assert list(iter_selectors(expr)) == [css('ul'), xpath('.//li'), css('li')]
+
+def test_compiled_expr():
+    from heq import CompiledExpr, evaluate, unary_func
+    tree = lxml.etree.HTML('<ul><li><a href="/1">a</a></li><li>b</li></ul>')
+    compiled = CompiledExpr(xpath('//li') / {'t': text, 'href': xpath('.//a') @ 'href'})
+    assert compiled(tree) == [{'t': 'a', 'href': '/1'}, {'t': 'b', 'href': ''}]
+    assert evaluate(compiled) is compiled
+    assert extract(compiled, tree) == compiled(tree)
+    with pytest.raises(TypeError):
+        CompiledExpr(xpath('//li') / unary_func('nonexistent'))
+
+def test_positional_pushdown():
+    html = '<div><a href="/1">1</a><p><a href="/2">2</a></p><a href="/3">3</a></div>'
+    tree = lxml.etree.HTML(html)
+    assert xpath('//a')[1].to_xpath() == '(//a)[2]'
+    assert xpath('//a')[-1].to_xpath() == '(//a)[last()]'
+    assert xpath('//a')[-3].to_xpath() == '(//a)[last() - 2]'
+    for sel in [xpath('//a'), xpath('//p/a | //div/a'), css('a')]:
+        elems = sel.select(tree)
+        for i in [0, 1, 2, -1, -2, -3]:
+            assert sel[i].select(tree) is elems[i]
+            assert extract(sel[i].text, tree) == elems[i].text
+            assert extract(sel[i] @ 'href', tree) == elems[i].get('href')
+        for i in [3, -4]:
+            with pytest.raises(IndexError):
+                extract(sel[i].text, tree)
+        assert extract(sel @ 'href', tree) == '/1'
+    assert extract(xpath('//p') / (xpath('.//a')[0] @ 'href'), tree) == ['/2']
+    assert extract(xpath('//nonexistent') @ 'href', tree) == ''
+    assert extract(css('nonexistent') @ 'href', tree) == ''
+
+def test_parse_cache(tmp_path, monkeypatch):
+    import heq
+    expr = parse('`//a` / {x: @href}')
+    assert heq._parse('`//a` / {x: @href}') is heq._parse('`//a` / {x: @href}')
+    expr.pred['y'] = text
+    assert parse('`//a` / {x: @href}') == xpath('//a') / {'x': attr('href')}
+    monkeypatch.setenv('HEQ_CACHE_DIR', str(tmp_path / 'cache'))
+    script = tmp_path / 'expr.heq'
+    script.write_text('`//a` / {x: @href}')
+    expected = xpath('//a') / {'x': attr('href')}
+    assert heq.load_script(str(script)) == expected
+    [cached] = (tmp_path / 'cache' / 'scripts').iterdir()
+    assert json.loads(cached.read_text()) == ['map_pred', ['xpath', '//a'], {'x': ['attr', 'href']}]
+    # the cache holds data, not code: anything else is ignored and replaced
+    import pickle
+    for content in [pickle.dumps(expected), b'["eval", "1"]']:
+        cached.write_bytes(content)
+        assert heq.load_script(str(script)) == expected
+        assert json.loads(cached.read_text())[0] == 'map_pred'
+    def fail(s, parser=None):
+        raise AssertionError('parse() should not be called')
+    monkeypatch.setattr(heq, 'parse', fail)
+    assert heq.load_script(str(script)) == expected
+    script.write_text('`//b` / {x: @href}')
+    with pytest.raises(AssertionError):
+        heq.load_script(str(script))
+    monkeypatch.setattr(heq, '__version__', 'other')
+    script.write_text('`//a` / {x: @href}')
+    with pytest.raises(AssertionError):
+        heq.load_script(str(script))
+
+def test_rd_parser():
+    import subprocess
+    for s in ['', '{ }', '`x` /', '`x`.txt', '`x`[a]', '``', '{a: text,,}', '`x` / `y` / text']:
+        with pytest.raises(heq.ParseError):
+            parse(s, 'rd')
+    assert parse('{a: `x`, b: @y,}', 'rd') == parse('{a: `x`, b: @y,}', 'parsimonious')
+    assert parse('$`x`[2] .text', 'rd') == css('x')[2].text
+    code = 'import sys, heq; heq.parse("`a` / text", "rd"); assert "parsimonious" not in sys.modules'
+    subprocess.run([sys.executable, '-c', code], check=True, cwd=str(Path(__file__).parent))
+
+def test_iter_extract():
+    from heq import iter_extract
+    html = '''<body><table>
+      <tr class="row"><td>1</td><td><a href="/1">one</a></td></tr>
+      <tr><td>skip</td></tr>
+      <tr class="row x"><td>2</td><td><a href="/2">two</a><ul><li>a</li><li>b</li></ul></td></tr>
+      <tr class="row"><td>3</td></tr>
+    </table>
+    <div class="n">outer<div class="n">inner</div></div>
+    </body>'''
+    for expr in [
+        css('tr.row') / {'n': xpath('./td[1]').text, 'href': css('a') @ 'href', 'li': css('li') / text},
+        xpath('//tr[@class="row"]') / {'cls': attr('class'), 'cells': xpath('./td') / text},
+        css('tr') / xpath('.//td')[0].text,
+        css('div.n') / text,
+    ]:
+        assert list(iter_extract(expr, html.encode('utf-8'))) == extract(expr, html)
+    for prolog in ['<!-- x -->', '<?php x ?>', '<!DOCTYPE html><!-- x -->']:
+        doc = (prolog + '<html><body><p>a</p><p>b</p></body></html>').encode('utf-8')
+        assert list(iter_extract(css('p') / text, doc)) == ['a', 'b']
+        assert run_cli('--stream', '-c', '$`p` / text', input=doc) == b'["a","b"]\n'
+    for expr in [
+        css('tr') / {'all': xpath('//td').text},
+        css('tr') / (xpath('../tr') @ 'class'),
+        css('tr td') / text,
+        xpath('//tr[1]') / text,
+        css('tr') / css('td'),
+        css('tr:first-child') / text,
+        css('tr') / css('td:first-child').text,
+        {'x': text},
+    ]:
+        with pytest.raises(ValueError):
+            iter_extract(expr, b'')
+
+def run_cli(*args, input=b''):
+    import subprocess
+    proc = subprocess.run(
+        [sys.executable, str(Path(__file__).parent / 'heq.py'), *args],
+        input=input, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+    )
+    return proc.stdout
+
+def test_ndjson():
+    from heq import CompiledExpr
+    html = b'<ul><li>a</li><li>b "\xc3\xa9"</li></ul>'
+    compiled = CompiledExpr(xpath('//li') / {'t': text})
+    tree = lxml.etree.HTML(html.decode('utf-8'))
+    assert list(compiled.iter(tree)) == compiled(tree)
+    assert list(CompiledExpr(text).iter(tree)) == ['ab "\xe9"']
+    expected = '{"t":"a"}\n{"t":"b \\"\xe9\\""}\n'.encode('utf-8')
+    assert run_cli('--ndjson', '`//li` / {t: text}', input=html) == expected
+    assert run_cli('--ndjson', '--stream', '`//li` / {t: text}', input=html) == expected
+    assert run_cli('--ndjson', '{t: `//li`.text}', input=html) == '{"t":"ab \\"\xe9\\""}\n'.encode('utf-8')
+
+def test_batch(tmp_path, monkeypatch):
+    paths = []
+    for i in range(20):
+        p = tmp_path / f'{i}.html'
+        p.write_text(f'<ul><li>{i}</li><li>x</li></ul>')
+        paths.append(str(p))
+    paths.insert(5, str(tmp_path / 'missing.html'))
+    expected = [
+        {'file': p, 'error': 'FileNotFoundError'} if p.endswith('missing.html') else
+        {'file': p, 'result': [Path(p).stem, 'x']}
+        for p in paths
+    ]
+    def load(out):
+        records = [json.loads(line) for line in out.decode('utf-8').splitlines()]
+        for r in records:
+            if 'error' in r:
+                r['error'] = r['error'].split(':')[0]
+        return records
+    args = [a for p in paths for a in ('-i', p)]
+    assert load(run_cli('-j', '1', *args, '$`li` / text')) == expected
+    assert load(run_cli('-j', '3', *args, '$`li` / text')) == expected
+    listing = ('\n'.join(paths) + '\n').encode('utf-8')
+    unordered = load(run_cli('-j', '3', '--unordered', '--input-list', '-', '$`li` / text', input=listing))
+    assert sorted(unordered, key=lambda r: r['file']) == sorted(expected, key=lambda r: r['file'])
+    assert load(run_cli('-j', '2', '--index', '--prune', *args, '$`li` / text')) == expected
+    import io, subprocess
+    pruned = []
+    monkeypatch.setattr(heq, 'prune_tree', lambda tree, expr: pruned.append(expr))
+    heq._run_batch(parse('$`li` / text'), paths[:3], io.BytesIO(), 1, index=True, prune=True)
+    assert heq._worker_expr.index and len(pruned) == 3
+    proc = subprocess.run([sys.executable, str(Path(__file__).parent / 'heq.py'), '--stream', '--profile', *args[:4], '$`li` / text'],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    assert load(proc.stdout) == expected[:2]
+    assert proc.stderr.decode('utf-8').splitlines() == ['heq: --{} is not supported with several inputs; ignoring it'.format(o) for o in ['stream', 'profile']]
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_extract_many(executor, monkeypatch):
+    from heq import extract_many
+    docs = [f'<ul><li>{i}</li><li>{i * 2}</li></ul>' for i in range(50)]
+    expr = css('li') / text
+    consumed = []
+    def gen():
+        for d in docs:
+            consumed.append(d)
+            yield d
+    results = extract_many(expr, gen(), workers=2, executor=executor)
+    assert next(results) == ['0', '0']
+    assert len(consumed) <= 5
+    assert list(results) == [extract(expr, d) for d in docs[1:]]
+    with pytest.raises(ValueError):
+        extract_many(expr, docs, executor='fiber')
+    # the options of a CompiledExpr reach the workers; run the process
+    # pool's initializer and tasks in threads of this process to see them
+    import concurrent.futures
+    monkeypatch.setattr(concurrent.futures, 'ProcessPoolExecutor', concurrent.futures.ThreadPoolExecutor)
+    compiled = heq.CompiledExpr(expr, index=True, batch=True)
+    assert list(extract_many(compiled, docs[:2], workers=1, executor=executor)) == [['0', '0'], ['1', '2']]
+    if executor == 'process':
+        assert heq._worker_expr.index and heq._worker_expr.batch
+
+def test_extract_async():
+    import asyncio
+    from heq import CompiledExpr, extract_async
+    compiled = CompiledExpr(css('li') / text)
+    async def run():
+        return await asyncio.gather(*(extract_async(compiled, f'<li>{i}</li>') for i in range(5)))
+    assert asyncio.run(run()) == [[str(i)] for i in range(5)]
+
+def test_bytes_input():
+    import io
+    import threading
+    from heq import iter_extract, sniff_encoding, _html_parser
+    body = '<ul><li>caf\u30a7</li><li>日本</li></ul>'
+    expected = ['caf\u30a7', '日本']
+    expr = css('li') / text
+    cases = [
+        body.encode('utf-8'),
+        b'\xef\xbb\xbf' + body.encode('utf-8'),
+        b'\xff\xfe' + body.encode('utf-16-le'),
+        b'\xfe\xff' + body.encode('utf-16-be'),
+        ('<meta charset="Shift_JIS">' + body).encode('shift_jis'),
+        ('<head><meta http-equiv="Content-Type" content="text/html; charset=euc-jp"></head>' + body).encode('euc-jp'),
+    ]
+    for data in cases:
+        assert extract(expr, data) == expected
+        assert extract(expr, io.BytesIO(data)) == expected
+        assert list(iter_extract(expr, data)) == expected
+    latin1 = '<meta charset="latin-1"><p>caf\xe9</p>'.encode('latin-1')
+    assert sniff_encoding(latin1) == ('latin-1', 0)
+    for data in [latin1, latin1 * 20000]:
+        assert extract(css('p')[0].text, data) == 'caf\xe9'
+        assert extract(css('p')[0].text, io.BytesIO(data)) == 'caf\xe9'
+        assert next(iter_extract(css('p') / text, data)) == 'caf\xe9'
+    assert sniff_encoding(b'<meta charset="utf-16">') == ('utf-8', 0)
+    assert sniff_encoding(b'<meta charset="bogus">') == ('utf-8', 0)
+    assert _html_parser(None) is _html_parser(None)
+    other = []
+    t = threading.Thread(target=lambda: other.append(_html_parser(None)))
+    t.start()
+    t.join()
+    assert other[0] is not _html_parser(None)
+    assert run_cli('--ndjson', '$`li` / text', input=cases[4]) == '"caf\u30a7"\n"日本"\n'.encode('utf-8')
+
+def test_profile():
+    from heq import Profile, CompiledExpr
+    source = '''`//li` / {
+        a: $`a`@href,
+        t: `.//a`[0].text
+    }'''
+    calls = []
+    profile = Profile(hook=lambda node, seconds, matches: calls.append((node, matches)))
+    compiled = CompiledExpr(parse(source), profile)
+    tree = lxml.etree.HTML('<ul><li><a href="/1">x</a></li><li><a>y</a></li></ul>')
+    assert compiled(tree) == [{'a': '/1', 't': 'x'}, {'a': '', 't': 'y'}]
+    summary = [(s.node, s.calls, s.matches) for s in profile.stats]
+    assert summary == [
+        (xpath('//li'), 1, 2),
+        (css('a') @ 'href', 2, 1),
+        (css('a'), 2, 2),
+        (xpath('.//a')[0].text, 2, 2),
+        (xpath('.//a')[0], 2, 2),
+    ]
+    assert len(calls) == 9
+    assert all(s.seconds >= 0 and s.mean <= s.seconds for s in profile.stats)
+    report = profile.report(source).splitlines()
+    assert len(report) == 6
+    assert report[1].split()[:2] == ['1:1', '`//li`']
+    assert report[2].split()[:2] == ['2:12', '$`a`@href']
+    assert report[5].split()[:2] == ['3:12', '`.//a`[0]']
+
+def test_common_subexpressions():
+    from heq import Profile, CompiledExpr
+    html = '''<table>
+      <tr class="athing"><td class="title"><a href="/1">one</a><a href="/x">x</a></td></tr>
+      <tr class="athing"><td class="title"><a href="/2">two</a></td></tr>
+    </table>'''
+    source = '''$`tr.athing` / {
+        title: `(./td[@class="title"]//a)[1]`.text,
+        link: `(./td[@class="title"]//a)[1]`@href,
+        first: `.//a`[0].text,
+        first_link: `.//a`[0]@href,
+        links: `.//a` / @href,
+        all: `.//a`.text,
+        one_link: $`a`@href,
+        one_link_again: $`a`@href,
+    }'''
+    expected = [
+        {'title': 'one', 'link': '/1', 'first': 'one', 'first_link': '/1', 'links': ['/1', '/x'], 'all': 'onex', 'one_link': '/1', 'one_link_again': '/1'},
+        {'title': 'two', 'link': '/2', 'first': 'two', 'first_link': '/2', 'links': ['/2'], 'all': 'two', 'one_link': '/2', 'one_link_again': '/2'},
+    ]
+    profile = Profile()
+    compiled = CompiledExpr(parse(source), profile)
+    tree = lxml.etree.HTML(html)
+    assert compiled(tree) == expected
+    calls = {}
+    for s in profile.stats:
+        if isinstance(s.node, (xpath, css, heq.selector_indexed)):
+            calls[s.node] = calls.get(s.node, 0) + s.calls
+    assert calls == {
+        css('tr.athing'): 1,
+        xpath('(./td[@class="title"]//a)[1]'): 2,
+        xpath('.//a')[0]: 2,
+        xpath('.//a'): 2,
+        css('a'): 2,
+    }
+    with pytest.raises(IndexError):
+        compiled(lxml.etree.HTML('<table><tr class="athing"><td>none</td></tr></table>'))
+    lines = profile.report(source).splitlines()
+    assert [l.split()[0] for l in lines[1:]] == ['1:1', '2:16', '2:16', '3:15', '4:16', '4:16', '5:21', '6:16', '7:14', '8:19', '8:19', '9:25']
+
+def test_extract_all(tmp_path):
+    from heq import extract_all, Profile, CompiledExpr
+    html = '<html><head><title>T</title></head><body><a href="/x">x</a><a href="/y">y</a></body></html>'
+    exprs = {
+        'meta': {'title': xpath('//title').text},
+        'links': xpath('//a') / attr('href'),
+        'texts': CompiledExpr(xpath('//a') / text),
+    }
+    expected = {'meta': {'title': 'T'}, 'links': ['/x', '/y'], 'texts': ['x', 'y']}
+    assert extract_all(exprs, html) == expected
+    profile = Profile()
+    compiled = CompiledExpr({'links': exprs['links'], 'texts': exprs['texts'].expr}, profile)
+    assert compiled(lxml.etree.HTML(html)) == {'links': ['/x', '/y'], 'texts': ['x', 'y']}
+    assert [(s.node, s.calls) for s in profile.stats] == [(xpath('//a'), 1)]
+    (tmp_path / 'meta.heq').write_text('{title: `//title`.text}')
+    (tmp_path / 'page.html').write_text(html)
+    out = run_cli('-i', str(tmp_path / 'page.html'), '-f', str(tmp_path / 'meta.heq'),
+                  '-e', 'links=`//a` / @href', '-e', 'texts=`//a` / text')
+    assert json.loads(out) == expected
+    out = run_cli('-f', 'head={}'.format(tmp_path / 'meta.heq'), input=html.encode())
+    assert json.loads(out) == {'head': {'title': 'T'}}
+    assert json.loads(run_cli('-f', str(tmp_path / 'meta.heq'), input=html.encode())) == {'title': 'T'}
+
+def test_batched_map(monkeypatch):
+    from heq import CompiledExpr, parse
+    html = '''<div>
+      <div class="row"><h2>a</h2><span class="x">1</span><b>p</b><b>q</b></div>
+      <div class="row x"><h2>b</h2><div class="row"><h2>c</h2><span class="x">2</span></div></div>
+      <div class="row"><h2>d</h2><b>r</b></div>
+    </div>'''
+    sources = [
+        '`//div[contains(@class, "row")]` / {h: `.//h2`.text, first: `.//h2`[0].text, x: $`.x` / text, b: `.//b` / text}',
+        '$`.row` / {h: $`h2` / text, x: $`.x`@class, n: `./h2`.text}',
+        '$`.row` / {rows: $`div.row` / {h: $`h2`.text}}',
+    ]
+    exprs = [parse(s) for s in sources] + [css('.row') / {'last': xpath('.//h2')[-1].text}]
+    tree = lxml.etree.HTML(html)
+    monkeypatch.setattr(heq, 'BATCH_MIN_ROWS', 1000)
+    expected = [CompiledExpr(e)(tree) for e in exprs]
+    monkeypatch.setattr(heq, 'BATCH_MIN_ROWS', 2)
+    monkeypatch.setattr(heq, 'BATCH_MAX_DESCENDANTS', 100)
+    assert [CompiledExpr(e, batch=True)(tree) for e in exprs] == expected
+    assert expected[0][1] == {'h': 'bc', 'first': 'b', 'x': ['bc2', '2'], 'b': []}
+    assert expected[3] == [{'last': 'a'}, {'last': 'c'}, {'last': 'c'}, {'last': 'd'}]
+    monkeypatch.setattr(heq, 'BATCH_MAX_MATCHES', 0)
+    assert [CompiledExpr(e, batch=True)(tree) for e in exprs] == expected
+    compiled = CompiledExpr(parse('$`.row` / {h: `.//h2`[0].text, b: `.//b`[0].text}'), batch=True)
+    with pytest.raises(IndexError):
+        compiled(tree)
+
+def test_nested_batched_map(monkeypatch):
+    from heq import CompiledExpr, Profile, parse
+    tree = lxml.etree.HTML('<html><body>{}</body></html>'.format(''.join(
+        '<table>{}</table>'.format(''.join('<tr><td>{}</td><td class="x">{}</td></tr>'.format(i, j) for j in range(8)))
+        for i in range(100))))
+    exprs = [parse(s) for s in [
+        '`//table` / {rows: `.//tr` / {a: `.//td`[0].text, b: `.//td`.text}}',
+        '$`table` / {rows: $`tr` / {a: $`td.x`[0].text, b: $`td`@class}}',
+    ]]
+    profiles = [Profile() for _ in exprs]
+    results = [CompiledExpr(e, p, batch=True)(tree) for e, p in zip(exprs, profiles)]
+    # each batched query searches only its own table, not the whole document
+    for p in profiles:
+        assert max(s.matches for s in p.stats) == 1600
+    assert results[0][99]['rows'][7] == {'a': '99', 'b': '997'}
+    profile = Profile()
+    assert CompiledExpr(exprs[0], profile)(tree) == results[0]
+    # without batch=True, each row is evaluated on its own
+    assert {heq._describe(s.node): s.calls for s in profile.stats}['`.//td`'] == 800
+    assert [CompiledExpr(e)(tree) for e in exprs] == results
+
+def test_document_index():
+    from heq import CompiledExpr, DocumentIndex, parse
+    html = '''<div id="main">
+      <p class="a b">x<span>s</span></p><p class="b">y</p><!-- c -->
+      <ul><li>1</li><li class="a">2</li></ul>
+      <div class="row"><p class="a">z</p></div>
+    </div><p class="a">w</p>'''
+    tree = lxml.etree.HTML(html)
+    index = DocumentIndex(tree)
+    contexts = [tree] + tree.xpath('//div | //ul | //p')
+    for s in ['p.a', 'P', '.b', '#main p', '#main > p.b', 'li + li', 'p.a.b', 'div#main.x', '.a .b', 'div.row p', '*.a']:
+        for context in contexts:
+            assert index.select(s, context) == css(s).select(context), (s, context)
+            assert css(s).select(context, index) == css(s).select(context)
+    for s in ['div p, li', 'li:first-child', '*', '[id] p']:
+        assert index.select(s, tree) is None
+    assert DocumentIndex(tree).select('p', lxml.etree.HTML('<p>other</p>')) is None
+    source = '$`div` / {p: $`p.a` / text, first: $`p`[0].text, id: $`#main`@id, lis: $`ul li` / text}'
+    assert CompiledExpr(parse(source), index=True)(tree) == CompiledExpr(parse(source))(tree)
+    assert list(CompiledExpr(parse(source), index=True).iter(tree)) == CompiledExpr(parse(source))(tree)
+
+@pytest.mark.parametrize('parser', ['parsimonious', 'rd'])
+def test_text_funcs(parser):
+    from heq import CompiledExpr, dot_text, normalize, strip, parse
+    html = '<ul><li>  a\n <b>b</b>  c <!-- x --></li><li> d </li></ul>'
+    tree = lxml.etree.HTML(html)
+    assert parse('`//li`.strip', parser) == xpath('//li').strip == dot_text(xpath('//li'), 'strip')
+    assert parse('$`li`[0] .normalize', parser) == css('li')[0].normalize
+    assert parse('{a: `//li` / strip, b: `//li` / normalize}', parser) == {'a': xpath('//li') / strip, 'b': xpath('//li') / normalize}
+    source = '{text: `//li`.text, strip: `//li`.strip, normalize: `//li`.normalize, first: `//li`[0].normalize, each: `//li` / strip, all: `//li` / normalize, raw: `//li` / text}'
+    assert CompiledExpr(parse(source, parser))(tree) == {
+        'text': '  a\n b  c  d ',
+        'strip': 'a\n b  c  d',
+        'normalize': 'a b c d',
+        'first': 'a b c',
+        'each': ['a\n b  c', 'd'],
+        'all': ['a b c', 'd'],
+        'raw': [''.join(li.itertext()) for li in tree.xpath('//li')],
+    }
+
+def test_pretty_format():
+    from heq import pretty_format, write_pretty
+    assert pretty_format({'a"b': 1, 'c': [1, 2, {'x\n': 'é'}]}) == '{"a\\"b": 1, "c": [1, 2, {"x\\n": "é"}]}'
+    obj = {'short': 1, 'long': ['x' * 30, 'y' * 30, 'z' * 30], 'nested': [{'a': 1}, []], 'empty': {}}
+    assert pretty_format(obj) == '''{
+  "short": 1,
+  "long": [
+    "xxxxxxxxxxxxxxxxxxxxxxxxxxxxxx",
+    "yyyyyyyyyyyyyyyyyyyyyyyyyyyyyy",
+    "zzzzzzzzzzzzzzzzzzzzzzzzzzzzzz"
+  ],
+  "nested": [{"a": 1}, []],
+  "empty": {}
+}'''
+    rows = [{'name': 'row {}'.format(i), 'values': list(range(i % 30))} for i in range(200)]
+    out = pretty_format(rows)
+    assert json.loads(out) == rows
+    parts = []
+    write_pretty(rows, parts.append)
+    assert len(parts) > 1 and ''.join(parts) == out
+    tree = lxml.etree.HTML('<ul><li>a</li><li><b>b</b><i>c</i></li></ul>')
+    assert pretty_format({'li': tree.xpath('//li')[0], 'n': 1}) == '{"li": <li>a</li>, "n": 1}'
+    assert pretty_format([tree.xpath('//li')[1], 'x' * 80]) == '[\n  <li>\n  <b>b</b><i>c</i>\n  </li>,\n  "{}"\n]'.format('x' * 80)
+    assert json.loads(run_cli('-d', '{a: `//li` / text, b: `//li`[0].text}', input=b'<ul><li>1</li><li>2</li></ul>')) == {'a': ['1', '2'], 'b': '1'}
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_json_backends(compact):
+    import io
+    from heq import JSON_BACKENDS, json_encoder, write_json, write_json_array, write_ndjson
+    pytest.importorskip('orjson')
+    values = [None, True, '', 'a"b\\\n\t\x00\x1f\x7f é   日本 \U0001f600', [], {}, [[]], {'k': {}},
+              {'a': ['x', None, {'b': []}], 'é "k"': [{'c': 'd'}, ['e']]}, [{'t': 'x'} for _ in range(3)]]
+    outputs = []
+    for backend in JSON_BACKENDS:
+        encoded = [json_encoder(compact, backend)(x) for x in values]
+        if compact:
+            assert encoded == [json.dumps(x, ensure_ascii=False, separators=(',', ':')).encode('utf-8') for x in values]
+        else:
+            assert encoded == [json.dumps(x, indent=2, ensure_ascii=False).encode('utf-8') for x in values]
+        fp = io.BytesIO()
+        for x in values:
+            write_json(x, fp, compact, backend)
+            write_json_array(iter(x if isinstance(x, list) else [x]), fp, compact, backend)
+        write_ndjson(values, fp, backend)
+        outputs.append(fp.getvalue())
+    assert outputs[0] == outputs[1]
+    floats = [0.0, -0.0, 1.5, 3.0, 0.1, 1e15, 1e16, 1e21, -1.5e21, 1e-4, 1e-5, -1.5e-5, 1e-7, 5e-324, 1.7976931348623157e308,
+              float('nan'), float('inf'), -float('inf'), {'1e+05': [1e-05, 'x 1e+21 NaN']}]
+    encoded = [[json_encoder(compact, backend)(x) for x in floats] for backend in JSON_BACKENDS]
+    assert encoded[0] == encoded[1]
+    assert encoded[0][7:15] == [b'1e21', b'-1.5e21', b'0.0001', b'0.00001', b'-0.000015', b'1e-7', b'5e-324', b'1.7976931348623157e308']
+    assert encoded[0][15:18] == [b'null'] * 3
+    with pytest.raises(ValueError):
+        json_encoder(compact, 'simplejson')
+    html = b'<ul><li>a</li><li>b</li></ul>'
+    for backend in JSON_BACKENDS:
+        args = ['--json-backend', backend] + (['-c'] if compact else [])
+        expected = b'{"a":["a","b"]}\n' if compact else b'{\n  "a": [\n    "a",\n    "b"\n  ]\n}\n'
+        assert run_cli(*args, '{a: `//li` / text}', input=html) == expected
+        expected = b'["a","b"]\n' if compact else b'[\n  "a",\n  "b"\n]\n'
+        assert run_cli(*args, '--stream', '`//li` / text', input=html) == expected
+        expected = b'{"n":null,"c":2e21}\n' if compact else b'{\n  "n": null,\n  "c": 2e21\n}\n'
+        assert run_cli(*args, '{n: `number(//li)`, c: `count(//li) * 1e21`}', input=html) == expected
+
+def test_prefix_parse():
+    import io
+    from heq import CompiledExpr, prefix_needs, extract_tree
+    assert prefix_needs(parse('{a: `//div[@id="h"]`[1].text, b: $`title`@lang}')) == [('div', 'self::div[@id="h"]', 2), ('title', 'self::title', 1)]
+    assert prefix_needs(parse('`//div[@id="h"]`.text')) is None
+    assert prefix_needs(parse('{a: $`title`[0].text, b: `//a` / @href}')) is None
+    assert prefix_needs(parse('$`ul > li`[0].text')) is None
+    assert prefix_needs(parse('{t: $`title`[0].text, a: $`.a`[0].text}')) is None
+    body = ''.join('<div class="row"><p>{}</p></div>'.format(i) for i in range(20000))
+    html = '<html><head><title>T</title></head><body><div class="a"><div class="a"><p>x</p></div>y</div>{}</body></html>'.format(body).encode('utf-8')
+    class Reader(io.BytesIO):
+        total = 0
+        def read(self, size=-1):
+            data = super().read(size)
+            self.total += len(data)
+            return data
+    cases = [
+        ('{t: $`title`[0].text, a: $`div.a`[0].text, b: `//div[@class="a"]`[1]@class}', True),
+        ('{t: $`title`[0].text, a: $`.a`[0].text}', False),
+        ('{p: `//p`[5].text}', True),
+        ('{p: `//p`[20000].text}', False),
+        ('{q: $`div.row`[0]@id, t: $`title`[0].text}', True),
+        ('{n: $`div.row`[19999]@class}', False),
+    ]
+    for source, early in cases:
+        compiled = CompiledExpr(parse(source))
+        fp = Reader(html)
+        assert compiled(extract_tree(fp, compiled)) == compiled(extract_tree(html)) == compiled(extract_tree(html, compiled.expr))
+        assert (fp.total < len(html) // 2) == early
+    assert extract(parse('{t: $`title`[0].text, a: $`.a`[0].text}'), html) == {'t': 'T', 'a': 'xy'}
+    # only done when asked for
+    fp, early = Reader(html), Reader(html)
+    assert extract(parse('{t: $`title`[0].text}'), fp) == extract(parse('{t: $`title`[0].text}'), early, stop_early=True) == {'t': 'T'}
+    assert fp.total == len(html) and early.total < len(html) // 2
+    expr = '{t: $`title`[0].text, p: `//p`[1].text}'
+    assert run_cli(expr, input=html) == run_cli('--stop-early', expr, input=html) == b'{\n  "t": "T",\n  "p": "0"\n}\n'
+
+def test_prune():
+    from heq import CompiledExpr, prune_plan, prune_tree
+    html = '''<html><head><style>p {}</style><script>var a = "<p>x</p>";</script></head><body>
+        <div class="item"><svg><path d="M0"/></svg><h2>A<script>1</script></h2>x<script>2</script>y<a href="/a">a</a></div>
+        <div class="item"><svg><a href="/svg">s</a></svg><h2>B</h2><noscript><p>n</p></noscript></div>
+        <p>p<svg><title>t</title></svg></p></body></html>'''
+    expr = parse('$`div.item` / {h: $`h2`[0].text, links: $`a` / @href, t: `.//h2`.normalize}')
+    assert prune_plan(expr) == (('script', 'style', 'noscript', 'template', 'svg'), ('a', 'div', 'h2'), ('h2',))
+    tree = lxml.etree.HTML(html)
+    expected = CompiledExpr(expr)(tree)
+    assert prune_tree(tree, CompiledExpr(expr)) == 6
+    assert CompiledExpr(expr)(tree) == expected == [{'h': 'A1', 'links': ['/a'], 't': 'A1'}, {'h': 'B', 'links': ['/svg'], 't': 'B'}]
+    assert [e.tag for e in tree.iter('script', 'svg', 'noscript')] == ['script', 'svg']
+    assert tree.xpath('string(//div[1])') == 'A1xya'
+    for source in ['$`li:nth-child(2)` / text', '$`h2 + p`@id', '$`.item` / text', '`//p[1]`.text', '`//p[contains(., "x")]`@id', '$`script, style, noscript, template, svg` / @id']:
+        with pytest.raises(ValueError):
+            prune_plan(parse(source))
+    source = '{svg: $`svg` / @width, t: $`p`[1].text, d: `(//div[@class="item"])[2]`@class}'
+    out = run_cli('--prune', source, input=html.encode('utf-8'))
+    assert out == run_cli(source, input=html.encode('utf-8'))
+    assert json.loads(out) == {"svg": ["", "", ""], "t": "pt", "d": "item"}
+
+def test_result_cache(tmp_path, monkeypatch):
+    import io
+    import os
+    import subprocess
+    import heq
+    from heq import CompiledExpr, ResultCache
+    monkeypatch.setenv('HEQ_CACHE_DIR', str(tmp_path / 'cache'))
+    html = '<ul><li>a</li><li>b é</li></ul>'
+    cache = ResultCache()
+    assert cache.path == tmp_path / 'cache' / 'results'
+    expr = parse('`//li` / {t: text}')
+    expected = [{'t': 'a'}, {'t': 'b é'}]
+    assert extract(expr, html.encode('utf-8'), cache=cache) == expected
+    assert extract(parse('`//li`   /   {t: text}'), io.BytesIO(html.encode('utf-8')), cache=cache) == expected
+    assert extract(expr, html, cache=cache) == expected
+    assert (cache.hits, cache.misses) == (1, 2)
+    def fail(*args):
+        raise AssertionError('the document should not be parsed')
+    monkeypatch.setattr(heq, 'extract_tree', fail)
+    assert extract(CompiledExpr(expr), html, cache=cache) == expected
+    assert cache.extract_json(CompiledExpr(expr), html.encode('utf-8')) == '[{"t":"a"},{"t":"b é"}]'.encode('utf-8')
+    assert cache.stats() == '3 hits, 2 misses'
+    monkeypatch.undo()
+
+    small = ResultCache(tmp_path / 'small', max_size=64)
+    for i in range(10):
+        small.extract_json(CompiledExpr(expr), '<li>{}</li>'.format('x' * i).encode('ascii'))
+        os.utime(small._entry(small.key(CompiledExpr(expr), b'b<li>' + b'x' * i + b'</li>')), (i, i))
+    entries = sorted(p.read_bytes() for p in (tmp_path / 'small').glob('*/*.json'))
+    assert sum(map(len, entries)) <= 64 and entries[-1] == b'[{"t":"xxxxxxxxx"}]'
+
+    pages = []
+    for i in range(3):
+        page = tmp_path / 'page{}.html'.format(i)
+        page.write_text('<p>{}</p>'.format(i // 2))
+        pages.append(str(page))
+    env = dict(os.environ, HEQ_CACHE_DIR=str(tmp_path / 'cli'))
+    def run(*args):
+        proc = subprocess.run([sys.executable, str(Path(__file__).parent / 'heq.py'), '--cache', '--cache-stats', *args],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True, env=env)
+        return proc.stdout, proc.stderr.decode('utf-8').strip()
+    assert run('-i', pages[0], '{p: `//p`[0].text}') == (b'{\n  "p": "0"\n}\n', 'heq: result cache: 0 hits, 1 misses')
+    assert run('-i', pages[1], '{ p : `//p`[0].text }') == (b'{\n  "p": "0"\n}\n', 'heq: result cache: 1 hits, 0 misses')
+    out, err = run('-j', '2', *['-i' + p for p in pages], '{p: `//p`[0].text}')
+    assert out.decode('utf-8').splitlines() == ['{{"file":"{}","result":{{"p":"{}"}}}}'.format(p, i // 2) for i, p in enumerate(pages)]
+    assert err == 'heq: result cache: 2 hits, 1 misses'
+
+@pytest.mark.parametrize('index', [False, True])
+def test_hoist(index):
+    from heq import CompiledExpr, Profile, hoist, hoisted, lint
+    expr = parse('$`li` / {t: text, site: `//title`[0].text, all: `(//li)` / text, rel: $`b` / {x: `/html/head/title`@lang, y: text}, c: {n: `//li`[1]@id}}')
+    assert [w.split(' does not')[0] for w in lint(expr)] == ['`//title`[0].text', '`(//li)` / ...', '`/html/head/title`@lang', '{n: `//li`[1]@id}']
+    optimized = hoist(expr)
+    assert isinstance(optimized.pred['site'], hoisted)
+    assert optimized.pred['t'] == text and optimized.pred['c'] == hoisted(expr.pred['c'])
+    assert lint(optimized) == [] and hoist(optimized) == optimized
+    assert lint(parse('`//li` / {t: text, u: `.//a`@href, v: $`a` / @href}')) == []
+    relative = parse('`//li` / {a: `/html and ./b`, b: `//li[1] = .`, c: `(//li)[1] | .`, d: `count(//li) - count(./b)`}')
+    assert lint(relative) == [] and hoist(relative) == relative
+    assert len(lint(parse('`//li` / {t: text, a: `(//li)[1]/b`, b: `//li[@id="x]"][1]//text()`}'))) == 2
+    tree = lxml.etree.HTML('<html><head><title lang="en">T</title></head><body><ul>{}</ul></body></html>'.format(
+        ''.join('<li id="{0}">{0}<b>x</b></li>'.format(i) for i in range(20))))
+    profile = Profile()
+    compiled = CompiledExpr(optimized, profile, index=index)
+    assert compiled(tree) == list(compiled.iter(tree)) == CompiledExpr(expr, index=index)(tree)
+    calls = {heq._describe(s.node): s.calls for s in profile.stats}
+    assert calls['`//title`[0].text'] == 2 and calls['$`li`'] == 2
+    assert CompiledExpr(optimized)(tree)[3]['site'] == 'T'
+    html = b'<title>T</title><ul><li>a</li><li>b</li></ul>'
+    assert run_cli('-O', '`//li` / {t: text, s: `//title`[0].text}', input=html) == run_cli('`//li` / {t: text, s: `//title`[0].text}', input=html)
+
+def test_server(tmp_path):
+    import base64, io, os, subprocess, time
+    server = heq.Server()
+    page = tmp_path / 'page.html'
+    page.write_text('<title>T</title><ul><li>a</li><li>b</li></ul>')
+    requests = [
+        {'define': {'items': '`//li` / text', 'both': {'t': '`//title`[0].text', 'n': '`//li`[1].text'}}},
+        {'name': 'items', 'path': str(page), 'id': 1},
+        {'name': 'both', 'html_base64': base64.b64encode(page.read_bytes()).decode('ascii')},
+        {'expr': '`//li` / text', 'html': '<li>c</li>', 'ndjson': True},
+        {'name': 'missing', 'html': '', 'id': 'x'},
+        {'expr': '`//li'},
+        {'expr': '`//li`'},
+        [],
+    ]
+    wfile = io.BytesIO()
+    server.serve(io.BytesIO(b''.join(json.dumps(r).encode('utf-8') + b'\n' for r in requests)), wfile)
+    responses = [json.loads(line) for line in wfile.getvalue().splitlines()]
+    assert responses[0] == {'defined': ['both', 'items']}
+    assert responses[1]['id'] == 1 and responses[1]['result'] == ['a', 'b']
+    assert set(responses[1]['time']) == {'compile', 'parse', 'evaluate'}
+    assert responses[2]['result'] == {'t': 'T', 'n': 'b'} and responses[3]['results'] == ['c']
+    assert responses[4] == {'id': 'x', 'error': "KeyError: \"no script named 'missing'\""}
+    assert responses[5]['error'].startswith('ParseError') and responses[6]['error'].startswith('ValueError')
+    assert responses[7] == {'error': 'TypeError: request must be a JSON object'}
+
+    proc = subprocess.run([sys.executable, str(Path(__file__).parent / 'heq.py'), '--serve', '-', '-e', 'li=`//li` / text'],
+                          input=b'{"name": "li", "html": "<li>d</li>"}\n', stdout=subprocess.PIPE, check=True)
+    assert json.loads(proc.stdout)['result'] == ['d']
+
+    sock = str(tmp_path / 'heq.sock')
+    daemon = subprocess.Popen([sys.executable, str(Path(__file__).parent / 'heq.py'), '--serve', sock])
+    try:
+        for _ in range(100):
+            if os.path.exists(sock):
+                break
+            time.sleep(0.05)
+        with heq.Client(sock) as client:
+            assert client.request(expr='`//title`[0].text', path=str(page))['result'] == 'T'
+        for args in [('-i', str(page), '`//li` / text'), ('--ndjson', '-i', str(page), '`//li` / text'),
+                     ('-e', 'a=`//li`[0].text', '-e', 'b=`//title`[0].text', '-i', str(page))]:
+            assert run_cli('--connect', sock, *args) == run_cli(*args)
+        assert run_cli('--connect', sock, '`//li`[0].text', input=page.read_bytes()) == b'"a"\n'
+        script = tmp_path / 's.heq'
+        script.write_text('`//li`[0].text')
+        for args in [('-i', str(page)), ('-f', str(script), '-i', str(page), '`//li`[1].text')]:
+            with pytest.raises(subprocess.CalledProcessError):
+                run_cli('--connect', sock, *args)
+    finally:
+        daemon.terminate()
+        daemon.wait()
+    assert run_cli('--connect', sock, '`//li`[1].text', input=page.read_bytes()) == b'"b"\n'